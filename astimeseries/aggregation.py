@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Bucketing, aggregation and gap filling helpers used by
+TimeSeries.history().
+
+Raw samples are streamed once, in time order, in to per-bucket
+accumulators. Only buckets that actually have samples are produced
+(a 'sparse' result.) The fixed grid of bucket start times is never
+queried for - it is computed arithmetically from the aligned start
+time and the bucket size - and the sparse result is merged against
+that grid in a single linear pass to produce null, last value carried
+forward, or linearly interpolated points for the empty buckets.
+"""
+
+# system imports
+#
+import calendar
+import datetime
+import math
+
+# django imports
+#
+from django.utils.timezone import utc
+
+# Gap filling modes for buckets that have no samples in them.
+#
+FILL_NULL     = 'null'     # Empty buckets have the value None
+FILL_PREVIOUS = 'previous' # Empty buckets carry the last value forward
+FILL_LINEAR   = 'linear'   # Empty buckets are linearly interpolated
+SUPPORTED_FILL_MODES = (FILL_NULL, FILL_PREVIOUS, FILL_LINEAR)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo = utc)
+
+####################################################################
+#
+def to_timestamp(when):
+    """
+    Convert a datetime in to a posix timestamp (float seconds since the
+    unix epoch.) Naive datetimes are assumed to be in UTC.
+
+    Arguments:
+    - `when`: the datetime to convert
+    """
+    return calendar.timegm(when.utctimetuple()) + when.microsecond / 1e6
+
+####################################################################
+#
+def from_timestamp(t):
+    """
+    Convert a posix timestamp in to a datetime with its timezone set to
+    UTC.
+
+    Arguments:
+    - `t`: float or integer posix timestamp
+    """
+    return datetime.datetime.utcfromtimestamp(t).replace(tzinfo = utc)
+
+####################################################################
+#
+def to_microseconds(when):
+    """
+    Convert a datetime in to integer microseconds since the unix epoch.
+    Naive datetimes are assumed to be in UTC.
+
+    Arguments:
+    - `when`: the datetime to convert
+    """
+    return calendar.timegm(when.utctimetuple()) * 1000000 + when.microsecond
+
+####################################################################
+#
+def from_microseconds(us):
+    """
+    Convert integer microseconds since the unix epoch in to a datetime
+    with its timezone set to UTC.
+
+    Arguments:
+    - `us`: integer microseconds
+    """
+    return EPOCH + datetime.timedelta(microseconds = us)
+
+####################################################################
+#
+def pick_bucket_size(span, ranges):
+    """
+    Choose a bucket size (in seconds) for a query covering `span`
+    seconds from the table of (range, bucket size) tuples in `ranges`
+    (see models.RANGES.) Spans larger than the last range use the last
+    range's bucket size.
+
+    Arguments:
+    - `span`: the length of the query in seconds
+    - `ranges`: sequence of (range, bucket size) tuples, ascending
+    """
+    for rng, size in ranges:
+        if span <= rng:
+            return size
+    return ranges[-1][1]
+
+####################################################################
+#
+def align(t, bucket_size):
+    """
+    Round the timestamp `t` down to a multiple of `bucket_size`.
+
+    Arguments:
+    - `t`: posix timestamp
+    - `bucket_size`: bucket size in seconds
+    """
+    return math.floor(t / bucket_size) * bucket_size
+
+####################################################################
+#
+def grid_length(start, end, bucket_size):
+    """
+    The number of buckets in the fixed grid that begins at `start` and
+    covers every timestamp up to and including `end`.
+
+    Arguments:
+    - `start`: posix timestamp of the first bucket
+    - `end`: posix timestamp of the last sample we want covered
+    - `bucket_size`: bucket size in seconds
+    """
+    if end < start:
+        return 0
+    return int((end - start) // bucket_size) + 1
+
+########################################################################
+########################################################################
+#
+class Bucket(object):
+    """
+    The running aggregate of all of the samples that fall in to a single
+    bucket. We keep enough state (count, sum, sum of squares, min, max,
+    first and last) to answer every supported aggregation function, and
+    two buckets covering different samples of the same bucket can be
+    merged together.
+    """
+    __slots__ = ('count', 'sum', 'sumsq', 'min', 'max', 'first',
+                 'first_time', 'last', 'last_time')
+
+    ####################################################################
+    #
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.min = None
+        self.max = None
+        self.first = None
+        self.first_time = None
+        self.last = None
+        self.last_time = None
+
+    ####################################################################
+    #
+    def add(self, t, value):
+        """
+        Add a sample to this bucket. Samples are expected to arrive in
+        time order.
+
+        Arguments:
+        - `t`: posix timestamp of the sample
+        - `value`: the sample's value as a float
+        """
+        if self.count == 0:
+            self.min = self.max = self.first = value
+            self.first_time = t
+        else:
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+        self.last = value
+        self.last_time = t
+        self.count += 1
+        self.sum += value
+        self.sumsq += value * value
+        return
+
+    ####################################################################
+    #
+    def merge(self, other):
+        """
+        Fold the samples summarized by `other` in to this bucket.
+
+        Arguments:
+        - `other`: another Bucket
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            for attr in self.__slots__:
+                setattr(self, attr, getattr(other, attr))
+            return
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if other.first_time < self.first_time:
+            self.first, self.first_time = other.first, other.first_time
+        if other.last_time >= self.last_time:
+            self.last, self.last_time = other.last, other.last_time
+        return
+
+    ####################################################################
+    #
+    def value(self, aggr_fn):
+        """
+        Return the aggregate of this bucket for the given aggregation
+        function (one of TimeSeries.SUPPORTED_AGG_FUNCTIONS)
+
+        Arguments:
+        - `aggr_fn`: name of the aggregation function
+        """
+        if aggr_fn == 'min':
+            return self.min
+        elif aggr_fn == 'max':
+            return self.max
+        elif aggr_fn == 'first':
+            return self.first
+        elif aggr_fn == 'last':
+            return self.last
+        mean = self.sum / self.count
+        if aggr_fn == 'mean':
+            return mean
+        # Population standard deviation. Clamp at zero because rounding
+        # can leave us with a tiny negative variance.
+        #
+        return math.sqrt(max(self.sumsq / self.count - mean * mean, 0.0))
+
+####################################################################
+#
+def accumulate(samples, start, bucket_size):
+    """
+    Stream the (timestamp, value) `samples` (in time order) in to
+    buckets on the grid that begins at `start`. Returns a list of
+    (bucket index, Bucket) tuples in order for only those buckets that
+    had samples in them.
+
+    Arguments:
+    - `samples`: iterable of (posix timestamp, float) tuples
+    - `start`: posix timestamp of the first bucket in the grid
+    - `bucket_size`: bucket size in seconds
+    """
+    sparse = []
+    cur_idx = None
+    cur = None
+    for t, value in samples:
+        idx = int((t - start) // bucket_size)
+        if idx != cur_idx:
+            cur = Bucket()
+            cur_idx = idx
+            sparse.append((idx, cur))
+        cur.add(t, value)
+    return sparse
+
+####################################################################
+#
+def chunks(length, nchunks):
+    """
+    Split a grid of `length` buckets in to at most `nchunks` runs of
+    whole buckets of (nearly) equal size. Returns a list of (first bucket,
+    last bucket + 1) tuples.
+
+    Arguments:
+    - `length`: number of buckets in the grid
+    - `nchunks`: how many runs to split it in to
+    """
+    nchunks = max(min(nchunks, length), 1)
+    bounds = [length * i // nchunks for i in range(nchunks + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(nchunks)]
+
+####################################################################
+#
+def merge_sparse(parts):
+    """
+    Merge several sparse results from accumulate() - for instance ones
+    computed in parallel over different parts of the same grid - in to a
+    single sparse result ordered by bucket index. Buckets with the same
+    index in different parts are merged together.
+
+    Arguments:
+    - `parts`: iterable of lists of (bucket index, Bucket) tuples
+    """
+    merged = {}
+    for part in parts:
+        for idx, bucket in part:
+            if idx in merged:
+                merged[idx].merge(bucket)
+            else:
+                merged[idx] = bucket
+    return sorted(merged.items(), key = lambda x: x[0])
+
+####################################################################
+#
+def fill_grid(sparse, start, bucket_size, length, fill = None):
+    """
+    Merge the sparse (bucket index, value) results in to the fixed grid of
+    `length` buckets beginning at `start` in one pass, returning a list of
+    (bucket start timestamp, value) tuples.
+
+    If `fill` is None only the buckets that have values are returned.
+    Otherwise every bucket in the grid is returned and empty buckets are
+    filled in according to the fill mode. Empty buckets before the first
+    value (and, for FILL_LINEAR, after the last value) are None.
+
+    Arguments:
+    - `sparse`: list of (bucket index, value) tuples ordered by index
+    - `start`: posix timestamp of the first bucket in the grid
+    - `bucket_size`: bucket size in seconds
+    - `length`: number of buckets in the grid
+    - `fill`: None, FILL_NULL, FILL_PREVIOUS or FILL_LINEAR
+    """
+    if fill is None:
+        return [(start + idx * bucket_size, v) for idx, v in sparse
+                if 0 <= idx < length]
+    if fill not in SUPPORTED_FILL_MODES:
+        raise ValueError("'%s' is not a valid fill mode" % fill)
+
+    result = []
+    pos = 0
+    nsparse = len(sparse)
+    prev_idx, prev_val = None, None
+    for idx in range(length):
+        # Skip any sparse values that fall before the grid.
+        #
+        while pos < nsparse and sparse[pos][0] < idx:
+            prev_idx, prev_val = sparse[pos]
+            pos += 1
+
+        t = start + idx * bucket_size
+        if pos < nsparse and sparse[pos][0] == idx:
+            prev_idx, prev_val = sparse[pos]
+            pos += 1
+            result.append((t, prev_val))
+        elif fill == FILL_NULL or prev_val is None:
+            result.append((t, None))
+        elif fill == FILL_PREVIOUS:
+            result.append((t, prev_val))
+        elif pos < nsparse:
+            next_idx, next_val = sparse[pos]
+            frac = float(idx - prev_idx) / (next_idx - prev_idx)
+            result.append((t, prev_val + (next_val - prev_val) * frac))
+        else:
+            result.append((t, None))
+    return result
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+A reproducible benchmark suite for the ingest, range query and aggregation
+paths of TimeSeries. It is run by the 'benchmark_timeseries' management
+command against whatever database is configured (sqlite is fine) and
+produces a list of result dicts suitable for dumping as JSON and comparing
+between runs.
+
+Synthetic series are generated from a seeded random number generator so
+every run sees the same data. Generators stream their samples so series of
+any size (up to the 100M sample range) can be produced without holding
+them in memory.
+"""
+
+# system imports
+#
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+# django imports
+#
+import django
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+# Our imports
+#
+from astimeseries import aggregation
+from astimeseries.models import TimeSeries, Datum, RANGES
+
+GAUGE   = 'gauge'
+COUNTER = 'counter'
+SHAPES = (GAUGE, COUNTER)
+
+# Start of every synthetic series: 2013.01.01 00:00:00 UTC
+#
+EPOCH_START = 1356998400
+
+BULK_BATCH = 1000
+
+# Optional accelerators that must not be loaded just by importing the app.
+#
+LAZY_MODULES = ('numpy', 'multiprocessing.pool')
+
+# Run in a fresh interpreter to measure how long it takes to set up django
+# with the given INSTALLED_APPS and which modules that loads.
+#
+IMPORT_SCRIPT = """
+import json, sys, timeit
+t0 = timeit.default_timer()
+import django
+from django.conf import settings
+settings.configure(INSTALLED_APPS = %r,
+                   DATABASES = {'default': {
+                       'ENGINE': 'django.db.backends.sqlite3',
+                       'NAME': ':memory:'}})
+django.setup()
+print(json.dumps({"seconds": timeit.default_timer() - t0,
+                  "modules": sorted(m for m in sys.modules
+                                    if sys.modules[m] is not None)}))
+"""
+
+####################################################################
+#
+def generate(n, shape = GAUGE, interval = 5, jitter = 0.0, seed = 0,
+             start = EPOCH_START):
+    """
+    A generator of `n` synthetic (datetime, value) samples.
+
+    A 'gauge' is a random walk around 50, a 'counter' only ever increases.
+    Samples are `interval` seconds apart. If `jitter` is non-zero each
+    timestamp is moved by a random amount up to +/- jitter * interval.
+
+    Arguments:
+    - `n`: number of samples
+    - `shape`: GAUGE or COUNTER
+    - `interval`: seconds between samples
+    - `jitter`: fraction of the interval to randomly move each sample by
+    - `seed`: seed for the random number generator
+    - `start`: posix timestamp of the first sample
+    """
+    if shape not in SHAPES:
+        raise ValueError("'%s' is not a valid series shape" % shape)
+    rng = random.Random(seed)
+    value = 50.0 if shape == GAUGE else 0
+    for i in range(n):
+        t = start + i * interval
+        if jitter:
+            t += rng.uniform(-jitter, jitter) * interval
+        if shape == GAUGE:
+            value += rng.gauss(0, 1)
+            yield (aggregation.from_timestamp(t), repr(round(value, 3)))
+        else:
+            value += rng.randint(0, 100)
+            yield (aggregation.from_timestamp(t), str(value))
+    return
+
+####################################################################
+#
+def timed(fn, repeat = 1):
+    """
+    Call `fn` `repeat` times and return the (best, median) wall time in
+    seconds along with the result of the last call.
+
+    Arguments:
+    - `fn`: callable taking no arguments
+    - `repeat`: how many times to call it
+    """
+    times = []
+    result = None
+    for i in range(repeat):
+        t0 = timeit.default_timer()
+        result = fn()
+        times.append(timeit.default_timer() - t0)
+    times.sort()
+    return times[0], times[len(times) // 2], result
+
+####################################################################
+#
+def _result(name, size, shape, jitter, best, median, points, **extra):
+    r = {
+        "benchmark": name,
+        "size": size,
+        "shape": shape,
+        "jitter": jitter,
+        "best": best,
+        "median": median,
+        "points": points,
+        "rate": points / best if best > 0 else None,
+        }
+    r.update(extra)
+    return r
+
+####################################################################
+#
+def import_cost(installed_apps):
+    """
+    Set up django with `installed_apps` in a new python process and return
+    a dict of how long that took ('seconds') and every module it loaded
+    ('modules').
+
+    Arguments:
+    - `installed_apps`: list of apps for INSTALLED_APPS
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in sys.path if p)
+    env.pop("DJANGO_SETTINGS_MODULE", None)
+    out = subprocess.check_output([sys.executable, "-c",
+                                   IMPORT_SCRIPT % (list(installed_apps),)],
+                                  env = env)
+    return json.loads(out.decode("utf-8"))
+
+####################################################################
+#
+def bench_import(repeat = 3):
+    """
+    Time setting up django with and without the astimeseries app, each in a
+    fresh process, and report which of the LAZY_MODULES were loaded by
+    merely importing the app (there should be none.)
+
+    Arguments:
+    - `repeat`: how many times to start each process
+    """
+    base = ["django.contrib.contenttypes"]
+    baseline = sorted(import_cost(base)["seconds"] for i in range(repeat))
+    runs = [import_cost(base + ["astimeseries"]) for i in range(repeat)]
+    times = sorted(r["seconds"] for r in runs)
+    return {
+        "benchmark": "import",
+        "best": times[0],
+        "median": times[len(times) // 2],
+        "baseline": baseline[0],
+        "lazy_modules_loaded": [m for m in LAZY_MODULES
+                                if m in runs[-1]["modules"]],
+        }
+
+####################################################################
+#
+def bench_insert(n, shape, jitter, insert_limit = 1000):
+    """
+    Time TimeSeries.insert() one sample at a time (for at most
+    `insert_limit` samples - it is the slow path) and bulk inserting the
+    whole series. Returns the list of results and the bulk loaded
+    TimeSeries which the caller is responsible for deleting.
+
+    Arguments:
+    - `n`: number of samples
+    - `shape`: GAUGE or COUNTER
+    - `jitter`: timestamp jitter, see generate()
+    - `insert_limit`: max number of samples to insert one at a time
+    """
+    fmt = TimeSeries.FLOAT if shape == GAUGE else TimeSeries.INT
+    results = []
+
+    t = TimeSeries.objects.create(name = "benchmark-insert", fmt = fmt)
+    m = min(n, insert_limit)
+    def insert():
+        with transaction.atomic():
+            for when, value in generate(m, shape, jitter = jitter):
+                t.insert(value, when)
+    best, median, _ = timed(insert)
+    results.append(_result("insert", n, shape, jitter, best, median, m))
+    t.delete()
+
+    t = TimeSeries.objects.create(name = "benchmark-%s-%d" % (shape, n),
+                                  fmt = fmt)
+    def bulk_insert():
+        batch = []
+        with transaction.atomic():
+            for when, value in generate(n, shape, jitter = jitter):
+                batch.append(Datum(timeseries = t, time = when,
+                                   value = value))
+                if len(batch) == BULK_BATCH:
+                    Datum.objects.bulk_create(batch)
+                    batch = []
+            if batch:
+                Datum.objects.bulk_create(batch)
+    best, median, _ = timed(bulk_insert)
+    results.append(_result("bulk_insert", n, shape, jitter, best, median, n))
+    return results, t
+
+####################################################################
+#
+def tiers(t):
+    """
+    A generator of (range, window start, window end) for every tier of
+    RANGES that fits in the timeseries, each window ending at the last
+    sample.
+
+    Arguments:
+    - `t`: the TimeSeries
+    """
+    first, last = t._bounds()
+    if first is None:
+        return
+    span = aggregation.to_timestamp(last) - aggregation.to_timestamp(first)
+    for rng, bucket_size in RANGES:
+        if rng > span:
+            break
+        yield (rng,
+               aggregation.from_timestamp(aggregation.to_timestamp(last) -
+                                          rng),
+               last)
+    return
+
+####################################################################
+#
+def bench_queries(t, n, shape, jitter, repeat = 3):
+    """
+    Time raw_history() and history() over every RANGES tier that fits in
+    the timeseries, and then history() over the whole series with the
+    segment file tier missing and hit.
+
+    Arguments:
+    - `t`: the bulk loaded TimeSeries
+    - `n`: number of samples in it
+    - `shape`: GAUGE or COUNTER
+    - `jitter`: timestamp jitter, see generate()
+    - `repeat`: how many times to repeat each query
+    """
+    results = []
+    for rng, frm, to in tiers(t):
+        best, median, raw = timed(lambda: t.raw_history(frm, to), repeat)
+        results.append(_result("raw_history", n, shape, jitter, best, median,
+                               len(raw), tier = rng))
+        best, median, hist = timed(lambda: t.history(frm, to), repeat)
+        results.append(_result("history", n, shape, jitter, best, median,
+                               len(raw), tier = rng, buckets = len(hist)))
+
+    directory = tempfile.mkdtemp()
+    try:
+        with override_settings(ASTIMESERIES_SEGMENT_DIR = directory):
+            first, last = t._bounds()
+            best, median, _ = timed(lambda: t.history(first, last), repeat)
+            results.append(_result("history_segment_miss", n, shape, jitter,
+                                   best, median, n))
+            best, median, _ = timed(lambda: t.export_segment(last))
+            results.append(_result("export_segment", n, shape, jitter,
+                                   best, median, n))
+            best, median, _ = timed(lambda: t.history(first, last), repeat)
+            results.append(_result("history_segment_hit", n, shape, jitter,
+                                   best, median, n))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+####################################################################
+#
+def run(sizes, shapes = SHAPES, jitters = (0.0, 0.2), repeat = 3,
+        insert_limit = 1000, log = None):
+    """
+    Run the whole suite for every combination of size, shape and jitter
+    and return a dict describing the environment and the results.
+
+    Arguments:
+    - `sizes`: list of series sizes
+    - `shapes`: list of series shapes (GAUGE, COUNTER)
+    - `jitters`: list of timestamp jitters, see generate()
+    - `repeat`: how many times to repeat each query
+    - `insert_limit`: max number of samples to insert one at a time
+    - `log`: if given, called with a message as each step starts
+    """
+    results = [bench_import(repeat)]
+    for n in sizes:
+        for shape in shapes:
+            for jitter in jitters:
+                if log:
+                    log("%d %s samples, jitter %s" % (n, shape, jitter))
+                res, t = bench_insert(n, shape, jitter, insert_limit)
+                results.extend(res)
+                try:
+                    results.extend(bench_queries(t, n, shape, jitter,
+                                                 repeat))
+                finally:
+                    t.delete()
+    return {
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connection.vendor,
+        "results": results,
+        }
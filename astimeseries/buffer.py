@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+A write-behind buffer in front of TimeSeries.insert().
+
+Samples added to an IngestBuffer are kept in memory, per process, and
+written to the db with a single bulk insert when the buffer holds
+`max_size` samples or every `interval` seconds (from a background thread),
+whichever comes first, and when the process exits.
+
+If settings.ASTIMESERIES_INGEST_BUFFER is set (to a dict of IngestBuffer
+keyword arguments) TimeSeries.insert() adds samples to a shared per
+process buffer instead of writing them to the db one at a time.
+
+Backpressure: the sample that fills the buffer flushes it in the caller's
+thread, so a collector can not get ahead of the db. If flushing fails the
+error is logged (the sample has been accepted, so add() does not raise
+and a caller that retries on errors will not add it twice) and the
+samples are kept to be retried, from the caller's thread only once
+another `max_size` samples have arrived. Once `max_pending` samples are
+waiting add() raises BufferFull instead of growing without bound.
+
+If `coalesce` is True samples for the same timeseries within the same
+minute are averaged in to a single sample at the start of that minute
+(just like the load_therms_from command does.) This only coalesces the
+samples that are in the buffer at the same time.
+"""
+
+# system imports
+#
+import atexit
+import logging
+import threading
+
+# django imports
+#
+from django.conf import settings
+from django.db import connection
+from django.utils.timezone import now
+
+log = logging.getLogger(__name__)
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+########################################################################
+########################################################################
+#
+class BufferFull(Exception):
+    """
+    Raised by IngestBuffer.add() when there are too many samples waiting to
+    be written because the db is not keeping up (or is not reachable.)
+    """
+    pass
+
+########################################################################
+########################################################################
+#
+class IngestBuffer(object):
+    """
+    Collect samples in memory and write them with one bulk insert per
+    flush.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, max_size = 1000, interval = 5.0,
+                 max_pending = 100000, coalesce = False):
+        """
+        Arguments:
+        - `max_size`: flush when this many samples are buffered
+        - `interval`: flush at least this often (seconds) from a background
+                      thread. None means no background flushing.
+        - `max_pending`: raise BufferFull instead of buffering more samples
+                         than this
+        - `coalesce`: average samples for the same timeseries and minute
+        """
+        self.max_size = max_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.coalesce = coalesce
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = {}  # timeseries -> list of samples
+        self.size = 0
+        self.flush_at = max_size  # flush from add() at this many samples
+        self.thread = None
+        self.stopped = threading.Event()
+        atexit.register(self.close)
+
+    ####################################################################
+    #
+    def add(self, timeseries, value, when = None):
+        """
+        Buffer a sample for the given timeseries.
+
+        Arguments:
+        - `timeseries`: the TimeSeries
+        - `value`: the value of the sample
+        - `when`: the time of the sample. Defaults to now.
+        """
+        if when is None:
+            when = now()
+        with self.lock:
+            if self.size >= self.max_pending:
+                raise BufferFull("%d samples waiting to be written" %
+                                 self.size)
+            samples = self.pending.get(timeseries)
+            if samples is None:
+                samples = self.pending[timeseries] = {} if self.coalesce \
+                    else []
+            if self.coalesce:
+                minute = when.replace(second = 0, microsecond = 0)
+                acc = samples.get(minute)
+                if acc is None:
+                    samples[minute] = [float(value), 1]
+                    self.size += 1
+                else:
+                    acc[0] += float(value)
+                    acc[1] += 1
+            else:
+                samples.append((when, value))
+                self.size += 1
+            full = self.size >= self.flush_at
+        if full:
+            try:
+                self.flush()
+            except Exception:
+                # The samples are still buffered. Do not retry on every
+                # add(), wait for another max_size samples (or for the
+                # background thread.)
+                #
+                log.exception("Flushing the ingest buffer failed, %d "
+                              "samples waiting", self.size)
+                with self.lock:
+                    self.flush_at = self.size + self.max_size
+        elif self.interval is not None and self.thread is None:
+            self._start()
+        return
+
+    ####################################################################
+    #
+    def flush(self):
+        """
+        Write every buffered sample to the db in one bulk insert. If that
+        fails the samples are put back to be retried and the exception is
+        raised.
+
+        Returns the number of samples written.
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                size, self.size = self.size, 0
+                self.flush_at = self.max_size
+            if not size:
+                return 0
+
+            rows = []
+            model = None
+            for timeseries, samples in pending.items():
+                model = timeseries.data.model
+                if self.coalesce:
+                    samples = [(minute, total / n) for minute, (total, n) in
+                               sorted(samples.items())]
+                rows.extend(model(timeseries = timeseries, time = when,
+                                  value = value) for when, value in samples)
+            try:
+                model.objects.bulk_create(rows)
+            except Exception:
+                self._requeue(pending, size)
+                raise
+
+            # Mark every timeseries we wrote to as updated in one query.
+            #
+            updated = now()
+            for timeseries in pending:
+                timeseries.updated = updated
+            timeseries.__class__.objects.filter(
+                pk__in = [t.pk for t in pending]).update(updated = updated)
+
+            # The samples were bulk inserted so there were no Datum signals
+            # to discard out of date segment files.
+            #
+            for timeseries, samples in pending.items():
+                if self.coalesce:
+                    earliest = min(samples)
+                else:
+                    earliest = min(when for when, value in samples)
+                timeseries._invalidate_segment(earliest)
+        return size
+
+    ####################################################################
+    #
+    def discard(self, timeseries):
+        """
+        Drop every buffered sample for the given timeseries without writing
+        it (for instance because its samples are being replaced.) Returns
+        the number of samples dropped.
+
+        Arguments:
+        - `timeseries`: the TimeSeries
+        """
+        with self.lock:
+            samples = self.pending.pop(timeseries, None)
+            n = len(samples) if samples else 0
+            self.size -= n
+        return n
+
+    ####################################################################
+    #
+    def _requeue(self, pending, size):
+        """
+        Put samples that could not be written back in to the buffer
+        """
+        with self.lock:
+            for timeseries, samples in pending.items():
+                newer = self.pending.get(timeseries)
+                if newer is None:
+                    self.pending[timeseries] = samples
+                elif self.coalesce:
+                    for minute, (total, n) in samples.items():
+                        acc = newer.setdefault(minute, [0.0, 0])
+                        if acc[1] == 0:
+                            self.size += 1
+                        acc[0] += total
+                        acc[1] += n
+                    size -= len(samples)
+                else:
+                    newer[:0] = samples
+            self.size += size
+        return
+
+    ####################################################################
+    #
+    def _start(self):
+        """
+        Start the background thread that flushes every `interval` seconds
+        """
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target = self._run,
+                                           name = "astimeseries-ingest")
+            self.thread.daemon = True
+            self.thread.start()
+        return
+
+    ####################################################################
+    #
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                # The samples are still buffered, we will try again on the
+                # next interval.
+                #
+                pass
+            finally:
+                # This thread has its own db connection, do not hold it
+                # open between flushes.
+                #
+                connection.close()
+        return
+
+    ####################################################################
+    #
+    def close(self):
+        """
+        Stop the background thread and write out anything still buffered.
+        Called automatically when the process exits.
+        """
+        self.stopped.set()
+        if self.thread is not None and \
+                self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        return self.flush()
+
+####################################################################
+#
+def get_buffer():
+    """
+    The per process IngestBuffer configured by
+    settings.ASTIMESERIES_INGEST_BUFFER, or None if there is no such
+    setting.
+    """
+    global _buffer
+    config = getattr(settings, "ASTIMESERIES_INGEST_BUFFER", None)
+    if config is None:
+        return None
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = IngestBuffer(**config)
+    return _buffer
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Converting whole columns of values to the format (type) of a timeseries
+in one call.
+
+If NumPy is installed int and float columns are converted by NumPy in C,
+otherwise by the built in int() and float(). NumPy is only imported the
+first time it is needed so that importing this module stays cheap.
+
+Decimal columns are quantized to the timeseries' precision using a
+decimal.Context that is created once per precision and reused.
+
+None values (empty buckets) are left as None.
+"""
+
+# system imports
+#
+import decimal
+
+# The numpy module once we have tried to import it: None if it is not
+# installed.
+#
+_NOT_LOADED = object()
+numpy = _NOT_LOADED
+
+# decimal.Context and quantize exponent, by precision
+#
+_decimal_contexts = {}
+
+####################################################################
+#
+def _numpy():
+    """
+    Return the numpy module, importing it the first time we are called, or
+    None if it is not installed.
+    """
+    global numpy
+    if numpy is _NOT_LOADED:
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        numpy = np
+    return numpy
+
+####################################################################
+#
+def decimal_context(precision):
+    """
+    Return the (decimal.Context, exponent) used to represent decimal
+    values with `precision` digits after the decimal point.
+
+    Arguments:
+    - `precision`: number of digits after the decimal point
+    """
+    ctx = _decimal_contexts.get(precision)
+    if ctx is None:
+        ctx = (decimal.Context(prec = max(28, precision + 19),
+                               rounding = decimal.ROUND_HALF_EVEN),
+               decimal.Decimal(1).scaleb(-precision))
+        _decimal_contexts[precision] = ctx
+    return ctx
+
+####################################################################
+#
+def to_int(value):
+    """
+    Convert a single value to an int the same way cast_many() converts an
+    int column: integers exactly (SNMP Counter64 values do not fit in a
+    float), anything else through a float so '2.5' becomes 2.
+
+    Arguments:
+    - `value`: a string, int or float
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+####################################################################
+#
+def to_decimal(value, precision):
+    """
+    Convert a single value to a Decimal with `precision` digits after the
+    decimal point.
+
+    Arguments:
+    - `value`: a string, int or float
+    - `precision`: number of digits after the decimal point
+    """
+    ctx, exp = decimal_context(precision)
+    if isinstance(value, float):
+        value = repr(value)
+    return ctx.create_decimal(value).quantize(exp, context = ctx)
+
+####################################################################
+#
+def _with_nones(fn, values):
+    """
+    Apply the column conversion `fn` to the values that are not None,
+    leaving the Nones where they were.
+    """
+    present = [i for i, v in enumerate(values) if v is not None]
+    if len(present) == len(values):
+        return fn(values)
+    result = [None] * len(values)
+    for i, v in zip(present, fn([values[i] for i in present])):
+        result[i] = v
+    return result
+
+####################################################################
+#
+def _ints(values):
+    # NumPy parses integer strings exactly, but gives up on the whole
+    # column if any value has a fractional part or does not fit in 64
+    # bits.
+    #
+    np = _numpy()
+    if np is not None:
+        try:
+            return np.asarray(values, dtype = np.int64).tolist()
+        except (ValueError, TypeError, OverflowError):
+            pass
+    return [to_int(v) for v in values]
+
+####################################################################
+#
+def _floats(values):
+    np = _numpy()
+    if np is not None:
+        return np.asarray(values, dtype = np.float64).tolist()
+    return [float(v) for v in values]
+
+####################################################################
+#
+def cast_many(values, fmt, precision = 2):
+    """
+    Convert a list of values (strings as stored in a Datum, or the floats
+    produced by aggregation) to `fmt`, one of the TimeSeries format
+    choices ('int', 'flo', 'dec' or 'raw'.) Returns a list.
+
+    Integer values of an 'int' column are converted exactly, values with
+    a fractional part are truncated.
+
+    Arguments:
+    - `values`: list of values
+    - `fmt`: the format to convert them to
+    - `precision`: digits after the decimal point for 'dec'
+    """
+    values = list(values)
+    if not values:
+        return values
+    if fmt == 'int':
+        return _with_nones(_ints, values)
+    elif fmt == 'flo':
+        return _with_nones(_floats, values)
+    elif fmt == 'dec':
+        ctx, exp = decimal_context(precision)
+        return [None if v is None else
+                ctx.create_decimal(repr(v) if isinstance(v, float) else v
+                                   ).quantize(exp, context = ctx)
+                for v in values]
+    return values
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Compression of runs of (timestamp, value) samples in to compact blobs
+following the scheme from Facebook's Gorilla paper ('Gorilla: A Fast,
+Scalable, In-Memory Time Series Database', Pelkonen et al, 2015.)
+
+o Timestamps are integer microseconds since the epoch. The first one is
+  stored in the block header. After that we store the delta-of-delta in
+  a variable number of bits - for regularly spaced samples this is a
+  single '0' bit per sample.
+
+o Values are 64 bit floats. The first one is stored in the block header.
+  After that we XOR each value with the previous one and only store the
+  meaningful (non-zero) bits of the result - for slowly changing values
+  this is a single '0' bit per sample.
+
+The block header is:
+
+    version (1 byte), count (4 bytes), first timestamp (8 bytes),
+    first value (8 bytes)
+
+all big endian.
+"""
+
+# system imports
+#
+import struct
+
+VERSION = 1
+HEADER = struct.Struct(">BIqd")
+
+# The delta-of-delta buckets: (control bits, number of control bits, number
+# of value bits). A delta-of-delta of 0 is written as a single '0' bit.
+#
+DOD_BUCKETS = (
+    (0x2, 2, 14),  # '10'   + 14 bits
+    (0x6, 3, 24),  # '110'  + 24 bits
+    (0xe, 4, 36),  # '1110' + 36 bits
+    (0xf, 4, 64),  # '1111' + 64 bits
+    )
+
+########################################################################
+########################################################################
+#
+class BitWriter(object):
+    """
+    Accumulate a stream of bits in to a bytearray.
+    """
+
+    ####################################################################
+    #
+    def __init__(self):
+        self.out = bytearray()
+        self.acc = 0
+        self.nbits = 0
+
+    ####################################################################
+    #
+    def write(self, value, nbits):
+        """
+        Write the low `nbits` bits of `value`.
+
+        Arguments:
+        - `value`: non-negative integer
+        - `nbits`: how many bits of it to write
+        """
+        self.acc = (self.acc << nbits) | (value & ((1 << nbits) - 1))
+        self.nbits += nbits
+        while self.nbits >= 8:
+            self.nbits -= 8
+            self.out.append((self.acc >> self.nbits) & 0xff)
+        self.acc &= (1 << self.nbits) - 1
+        return
+
+    ####################################################################
+    #
+    def getvalue(self):
+        """
+        Return the bits written so far padded out to a whole byte.
+        """
+        out = bytearray(self.out)
+        if self.nbits:
+            out.append((self.acc << (8 - self.nbits)) & 0xff)
+        return bytes(out)
+
+########################################################################
+########################################################################
+#
+class BitReader(object):
+    """
+    Read a stream of bits from a buffer, starting at a given byte offset.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, data, offset = 0):
+        self.data = data
+        self.pos = offset
+        self.acc = 0
+        self.nbits = 0
+
+    ####################################################################
+    #
+    def read(self, nbits):
+        """
+        Read `nbits` bits and return them as a non-negative integer.
+
+        Arguments:
+        - `nbits`: how many bits to read
+        """
+        while self.nbits < nbits:
+            self.acc = (self.acc << 8) | self.data[self.pos]
+            self.pos += 1
+            self.nbits += 8
+        self.nbits -= nbits
+        value = self.acc >> self.nbits
+        self.acc &= (1 << self.nbits) - 1
+        return value
+
+####################################################################
+#
+def _float_bits(value):
+    return struct.unpack(">Q", struct.pack(">d", value))[0]
+
+####################################################################
+#
+def _bits_float(bits):
+    return struct.unpack(">d", struct.pack(">Q", bits))[0]
+
+####################################################################
+#
+def _signed(value, nbits):
+    if value >= 1 << (nbits - 1):
+        value -= 1 << nbits
+    return value
+
+####################################################################
+#
+def _leading_zeros(x):
+    return 64 - x.bit_length()
+
+####################################################################
+#
+def _trailing_zeros(x):
+    return (x & -x).bit_length() - 1
+
+####################################################################
+#
+def encode(samples):
+    """
+    Compress a list of (timestamp, value) samples in to a block. The
+    timestamps are integer microseconds and must be in ascending order.
+    The values are floats.
+
+    Arguments:
+    - `samples`: list of (int, float) tuples
+    """
+    if not samples:
+        raise ValueError("can not encode an empty block")
+    first_t, first_v = samples[0]
+    header = HEADER.pack(VERSION, len(samples), first_t, first_v)
+
+    w = BitWriter()
+    prev_t, prev_delta = first_t, 0
+    prev_bits = _float_bits(first_v)
+    prev_lead, prev_trail = None, None
+    for t, v in samples[1:]:
+        # The timestamp as a delta of deltas
+        #
+        delta = t - prev_t
+        dod = delta - prev_delta
+        prev_t, prev_delta = t, delta
+        if dod == 0:
+            w.write(0, 1)
+        else:
+            for ctrl, nctrl, nbits in DOD_BUCKETS:
+                if -(1 << (nbits - 1)) <= dod < (1 << (nbits - 1)):
+                    w.write(ctrl, nctrl)
+                    w.write(dod, nbits)
+                    break
+
+        # The value XOR'd with the previous value
+        #
+        bits = _float_bits(v)
+        xor = bits ^ prev_bits
+        prev_bits = bits
+        if xor == 0:
+            w.write(0, 1)
+            continue
+        lead = min(_leading_zeros(xor), 31)
+        trail = _trailing_zeros(xor)
+        if prev_lead is not None and lead >= prev_lead and \
+                trail >= prev_trail:
+            # Fits in the previous window of meaningful bits
+            #
+            w.write(0x2, 2)
+            w.write(xor >> prev_trail, 64 - prev_lead - prev_trail)
+        else:
+            meaningful = 64 - lead - trail
+            w.write(0x3, 2)
+            w.write(lead, 5)
+            w.write(meaningful & 0x3f, 6) # 64 is written as 0
+            w.write(xor >> trail, meaningful)
+            prev_lead, prev_trail = lead, trail
+    return header + w.getvalue()
+
+####################################################################
+#
+def decode(blob):
+    """
+    A generator that decompresses a block produced by encode() yielding
+    its (timestamp, value) samples in order.
+
+    Arguments:
+    - `blob`: the compressed block (bytes or any buffer)
+    """
+    data = bytearray(blob)
+    version, count, t, v = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("unknown block version %d" % version)
+    yield (t, v)
+
+    r = BitReader(data, HEADER.size)
+    read = r.read
+    delta = 0
+    bits = _float_bits(v)
+    lead, trail = 0, 0
+    for i in range(count - 1):
+        if read(1):
+            for ctrl, nctrl, nbits in DOD_BUCKETS[:-1]:
+                if not read(1):
+                    break
+            else:
+                nbits = DOD_BUCKETS[-1][2]
+            delta += _signed(read(nbits), nbits)
+        t += delta
+
+        if read(1):
+            if read(1):
+                lead = read(5)
+                meaningful = read(6) or 64
+                trail = 64 - lead - meaningful
+            bits ^= read(64 - lead - trail) << trail
+        yield (t, _bits_float(bits))
+    return
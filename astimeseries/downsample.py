@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Visual downsampling of a series using the Largest-Triangle-Three-Buckets
+algorithm (Sveinn Steinarsson, 'Downsampling Time Series for Visual
+Representation', 2013.)
+
+The first and last samples are always kept. The samples between them are
+divided in to threshold - 2 buckets of equal *time* width and from each
+bucket we keep the one sample that forms the largest triangle with the
+sample kept from the previous bucket and the average of the next bucket.
+
+Because the buckets are bounded by time and not by sample count we do not
+need to hold the samples in memory. We make two passes over the samples:
+the first collects the per-bucket averages, the second picks the sample
+to keep from each bucket. Both passes are O(n) in time and only keep O(N)
+state where N is the threshold.
+"""
+
+####################################################################
+#
+def lttb_stream(samples, start, end, threshold):
+    """
+    Downsample a series to at most `threshold` samples.
+
+    `samples` is a callable that returns a new iterator of
+    (x, y, item) tuples ordered by x each time it is called. It will be
+    called twice. 'x' and 'y' are the floats used to compute the triangle
+    areas and 'item' is what is returned for the samples we keep.
+
+    Returns the list of the kept items, in order.
+
+    Arguments:
+    - `samples`: callable returning an iterator of (x, y, item) tuples
+    - `start`: x of the first sample
+    - `end`: x of the last sample
+    - `threshold`: the maximum number of samples to return (at least 3)
+    """
+    if threshold < 3:
+        raise ValueError("LTTB needs a threshold of at least 3")
+    nbuckets = threshold - 2
+    width = float(end - start) / nbuckets
+
+    def bucket(x):
+        if width == 0:
+            return 0
+        return min(int((x - start) / width), nbuckets - 1)
+
+    # First pass: the average x and y of each bucket. The first and last
+    # samples are not part of any bucket.
+    #
+    sums = [[0, 0.0, 0.0] for i in range(nbuckets)]
+    first = last = None
+    for sample in samples():
+        if first is None:
+            first = sample
+            continue
+        if last is not None:
+            acc = sums[bucket(last[0])]
+            acc[0] += 1
+            acc[1] += last[0]
+            acc[2] += last[1]
+        last = sample
+    if first is None:
+        return []
+    if last is None:
+        return [first[2]]
+
+    # For each bucket the point that the next triangle vertex is taken from
+    # is the average of the next non-empty bucket, or the last sample if
+    # there is no such bucket.
+    #
+    nxt = [None] * nbuckets
+    c = (last[0], last[1])
+    for i in range(nbuckets - 1, -1, -1):
+        nxt[i] = c
+        n, sx, sy = sums[i]
+        if n:
+            c = (sx / n, sy / n)
+    del sums
+
+    # Second pass: pick the sample in each bucket that forms the largest
+    # triangle with the previously kept sample and the next bucket's
+    # average.
+    #
+    result = [first[2]]
+    ax, ay = first[0], first[1]
+    cur, best, best_area = None, None, -1.0
+    it = samples()
+    next(it)
+    prev = None
+    for sample in it:
+        if prev is not None:
+            x, y = prev[0], prev[1]
+            idx = bucket(x)
+            if idx != cur:
+                if best is not None:
+                    result.append(best[2])
+                    ax, ay = best[0], best[1]
+                cur, best, best_area = idx, None, -1.0
+            cx, cy = nxt[idx]
+            area = abs((ax - cx) * (y - ay) - (ax - x) * (cy - ay))
+            if area > best_area:
+                best, best_area = prev, area
+        prev = sample
+    if best is not None:
+        result.append(best[2])
+    result.append(last[2])
+    return result
+
+####################################################################
+#
+def lttb(points, threshold):
+    """
+    Downsample an in-memory list of (x, y) points to at most
+    `threshold` points. Points whose y is None are dropped.
+
+    Arguments:
+    - `points`: list of (x, y) tuples ordered by x
+    - `threshold`: the maximum number of points to return (at least 3)
+    """
+    points = [p for p in points if p[1] is not None]
+    if len(points) <= threshold:
+        return points
+    return lttb_stream(lambda: ((p[0], p[1], p) for p in points),
+                       points[0][0], points[-1][0], threshold)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+A django management command that runs the astimeseries benchmark suite
+(see astimeseries.benchmarks) against the configured database and writes
+the results as JSON for comparing against previous runs.
+"""
+
+# system imports
+#
+import json
+
+# django imports
+#
+from django.core.management.base import BaseCommand, CommandError
+
+# Our imports
+#
+from astimeseries import benchmarks
+
+########################################################################
+########################################################################
+#
+class Command(BaseCommand):
+    """
+    Run the ingest, range query and aggregation benchmarks.
+    """
+
+    help = "Runs the timeseries benchmark suite and writes the results " \
+        "as JSON."
+
+    ####################################################################
+    #
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default = "1000,10000,100000",
+                            help = "Comma separated list of series sizes")
+        parser.add_argument("--shapes", default = ",".join(benchmarks.SHAPES),
+                            help = "Comma separated list of series shapes "
+                            "(gauge, counter)")
+        parser.add_argument("--jitters", default = "0,0.2",
+                            help = "Comma separated list of timestamp "
+                            "jitters as a fraction of the sample interval")
+        parser.add_argument("--repeat", type = int, default = 3,
+                            help = "How many times to repeat each query")
+        parser.add_argument("--insert-limit", type = int, default = 1000,
+                            help = "Max number of samples to insert one "
+                            "at a time")
+        parser.add_argument("--output", default = None,
+                            help = "File to write the JSON results to. "
+                            "Defaults to stdout")
+        return
+
+    ####################################################################
+    #
+    def handle(self, *args, **options):
+        """
+        Run the benchmarks and write out the results.
+
+        Arguments:
+        - `*args`:
+        - `**options`: see add_arguments()
+        """
+        try:
+            sizes = [int(x) for x in options["sizes"].split(",")]
+            jitters = [float(x) for x in options["jitters"].split(",")]
+        except ValueError as e:
+            raise CommandError("Bad --sizes or --jitters: %s" % e)
+        shapes = options["shapes"].split(",")
+        for shape in shapes:
+            if shape not in benchmarks.SHAPES:
+                raise CommandError("Unknown series shape '%s'" % shape)
+
+        def log(msg):
+            self.stderr.write(msg)
+
+        result = benchmarks.run(sizes, shapes, jitters, options["repeat"],
+                                options["insert_limit"], log = log)
+        out = json.dumps(result, indent = 2, sort_keys = True)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(out)
+        else:
+            self.stdout.write(out)
+        return
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+A django management command that writes timeseries and their samples to a
+compact binary snapshot file (see astimeseries.snapshot.) Much faster and
+smaller than 'dumpdata' for large series.
+"""
+
+# django imports
+#
+from django.core.management.base import BaseCommand, CommandError
+
+# Our imports
+#
+from astimeseries import snapshot
+from astimeseries.models import TimeSeries
+
+########################################################################
+########################################################################
+#
+class Command(BaseCommand):
+    """
+    Dump timeseries to a binary snapshot file.
+    """
+
+    help = "Writes the named timeseries (or all of them) and their samples " \
+        "to a binary snapshot file."
+
+    ####################################################################
+    #
+    def add_arguments(self, parser):
+        parser.add_argument("file", help = "The snapshot file to write")
+        parser.add_argument("names", nargs = "*",
+                            help = "Names of the timeseries to dump. "
+                            "Defaults to all of them")
+        parser.add_argument("--compress", action = "store_true",
+                            default = False,
+                            help = "zlib compress the samples")
+        parser.add_argument("--chunk-size", type = int,
+                            default = snapshot.CHUNK_SIZE,
+                            help = "Number of samples per chunk")
+        return
+
+    ####################################################################
+    #
+    def handle(self, *args, **options):
+        """
+        Write the snapshot.
+
+        Arguments:
+        - `*args`:
+        - `**options`: see add_arguments()
+        """
+        queryset = TimeSeries.objects.order_by("name")
+        if options["names"]:
+            queryset = queryset.filter(name__in = options["names"])
+            missing = set(options["names"]) - \
+                set(queryset.values_list("name", flat = True))
+            if missing:
+                raise CommandError("No such timeseries: %s" %
+                                   ", ".join(sorted(missing)))
+
+        with open(options["file"], "wb") as f:
+            nseries, nsamples = snapshot.dump(f, queryset,
+                                              options["compress"],
+                                              options["chunk_size"])
+        self.stdout.write("Dumped %d samples in %d timeseries" %
+                          (nsamples, nseries))
+        return
@@ -67,7 +67,7 @@ class Command(BaseCommand):
         #
         try:
             t = TimeSeries.objects.get(name=file_name)
-            t.data.all().delete()
+            t.clear()
         except TimeSeries.DoesNotExist, e:
             t = TimeSeries(name=file_name)
             t.save()
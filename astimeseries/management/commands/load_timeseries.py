@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+A django management command that restores timeseries and their samples
+from a binary snapshot file written by dump_timeseries (see
+astimeseries.snapshot.)
+"""
+
+# django imports
+#
+from django.core.management.base import BaseCommand, CommandError
+
+# Our imports
+#
+from astimeseries import snapshot
+
+########################################################################
+########################################################################
+#
+class Command(BaseCommand):
+    """
+    Load timeseries from a binary snapshot file.
+    """
+
+    help = "Restores the timeseries and samples in a binary snapshot file."
+
+    ####################################################################
+    #
+    def add_arguments(self, parser):
+        parser.add_argument("file", help = "The snapshot file to read")
+        parser.add_argument("--replace", action = "store_true",
+                            default = False,
+                            help = "Replace the samples of timeseries that "
+                            "already exist instead of failing")
+        return
+
+    ####################################################################
+    #
+    def handle(self, *args, **options):
+        """
+        Read the snapshot.
+
+        Arguments:
+        - `*args`:
+        - `**options`: see add_arguments()
+        """
+        try:
+            with open(options["file"], "rb") as f:
+                nseries, nsamples = snapshot.load(f, options["replace"])
+        except (IOError, snapshot.SnapshotError) as e:
+            raise CommandError(str(e))
+        self.stdout.write("Loaded %d samples in %d timeseries" %
+                          (nsamples, nseries))
+        return
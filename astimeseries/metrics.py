@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Instrumentation of the TimeSeries query and insert methods.
+
+Each call of an instrumented method records its wall time, how many db
+queries it made, how many samples it read and returned, how many buckets
+it produced and whether it was answered from the segment file tier (a
+'hit'), partly from it (a 'partial' hit) or only from the db (a 'miss'.)
+The resulting CallStats are sent with the
+astimeseries.signals.call_finished signal and handed to every registered
+metrics sink.
+
+Sinks are registered with add_sink() or listed (as dotted paths to
+classes that take no arguments) in settings.ASTIMESERIES_METRICS_SINKS.
+Two sinks are provided: PrometheusSink, which keeps running totals and
+renders them in the Prometheus text format, and StatsdSink which sends
+each call to a statsd server over UDP.
+
+If there are no sinks and nothing is listening to the signal the
+instrumented methods are called directly and cost nothing extra.
+
+NOTE: Counting db queries turns on django's query logging for the
+      default connection for the duration of the call, in to a log of its
+      own that is thrown away afterwards (unless DEBUG is on, then the
+      queries are added to the connection's usual log.)
+"""
+
+# system imports
+#
+import collections
+import functools
+import socket
+import threading
+import timeit
+
+# django imports
+#
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+# Our imports
+#
+from astimeseries.signals import call_finished
+
+# How the segment file tier answered a call
+#
+HIT     = 'hit'
+PARTIAL = 'partial'
+MISS    = 'miss'
+
+_local = threading.local()
+_sinks = []
+_settings_sinks = None
+
+########################################################################
+########################################################################
+#
+class CallStats(object):
+    """
+    What happened during one call of an instrumented TimeSeries method.
+    Counts that do not apply to the method are None.
+    """
+    __slots__ = ('method', 'series', 'args', 'kwargs', 'seconds', 'queries',
+                 'rows_scanned', 'rows_returned', 'buckets', 'cache')
+
+    ####################################################################
+    #
+    def __init__(self, method, series, args, kwargs):
+        self.method = method
+        self.series = series
+        self.args = args
+        self.kwargs = kwargs
+        self.seconds = None
+        self.queries = None
+        self.rows_scanned = None
+        self.rows_returned = None
+        self.buckets = None
+        self.cache = None
+
+    ####################################################################
+    #
+    def __repr__(self):
+        return "<CallStats %s(%s) %.6fs queries=%s scanned=%s returned=%s " \
+            "buckets=%s cache=%s>" % (self.method, self.series, self.seconds,
+                                      self.queries, self.rows_scanned,
+                                      self.rows_returned, self.buckets,
+                                      self.cache)
+
+####################################################################
+#
+def add_sink(sink):
+    """
+    Register a metrics sink. A sink is any object with a record(stats)
+    method.
+
+    Arguments:
+    - `sink`: the sink
+    """
+    _sinks.append(sink)
+    return
+
+####################################################################
+#
+def remove_sink(sink):
+    """
+    Unregister a metrics sink added with add_sink()
+
+    Arguments:
+    - `sink`: the sink
+    """
+    _sinks.remove(sink)
+    return
+
+####################################################################
+#
+def sinks():
+    """
+    All of the registered sinks, including the ones listed in
+    settings.ASTIMESERIES_METRICS_SINKS.
+    """
+    global _settings_sinks
+    if _settings_sinks is None:
+        _settings_sinks = [import_string(path)() for path in
+                           getattr(settings, "ASTIMESERIES_METRICS_SINKS", ())]
+    return _settings_sinks + _sinks
+
+####################################################################
+#
+def current():
+    """
+    The CallStats of the instrumented call in progress in this thread, or
+    None.
+    """
+    return getattr(_local, "stats", None)
+
+####################################################################
+#
+def record(**kwargs):
+    """
+    Set attributes of the CallStats of the call in progress, if there is
+    one.
+
+    Arguments:
+    - `**kwargs`: CallStats attributes and their values
+    """
+    stats = current()
+    if stats is not None:
+        for k, v in kwargs.items():
+            setattr(stats, k, v)
+    return
+
+####################################################################
+#
+def counted(samples):
+    """
+    Count the samples read from `samples` as rows scanned by the call in
+    progress. If there is no call in progress `samples` is returned as is.
+
+    Arguments:
+    - `samples`: an iterable
+    """
+    stats = current()
+    if stats is None:
+        return samples
+    if stats.rows_scanned is None:
+        stats.rows_scanned = 0
+    def counter():
+        for sample in samples:
+            stats.rows_scanned += 1
+            yield sample
+    return counter()
+
+####################################################################
+#
+def instrumented(fn):
+    """
+    Decorator for the TimeSeries methods we instrument. Calls made while
+    another instrumented call is in progress in the same thread are counted
+    as part of the outer call.
+
+    Arguments:
+    - `fn`: the method
+    """
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        if current() is not None or \
+                not (call_finished.has_listeners() or sinks()):
+            return fn(self, *args, **kwargs)
+
+        # The connection's own query log is bounded (and not reset outside
+        # of a request) so we count the queries in a fresh one.
+        #
+        stats = CallStats(fn.__name__, self.name, args, kwargs)
+        logged = connection.queries_logged
+        queries_log = connection.queries_log
+        force_debug_cursor = connection.force_debug_cursor
+        connection.queries_log = collections.deque()
+        connection.force_debug_cursor = True
+        _local.stats = stats
+        t0 = timeit.default_timer()
+        try:
+            result = fn(self, *args, **kwargs)
+        finally:
+            stats.seconds = timeit.default_timer() - t0
+            _local.stats = None
+            stats.queries = len(connection.queries_log)
+            if logged:
+                queries_log.extend(connection.queries_log)
+            connection.queries_log = queries_log
+            connection.force_debug_cursor = force_debug_cursor
+
+        if isinstance(result, list):
+            stats.rows_returned = len(result)
+        elif result is not None:
+            stats.rows_returned = 1
+        call_finished.send(sender = self.__class__, timeseries = self,
+                           stats = stats)
+        for sink in sinks():
+            sink.record(stats)
+        return result
+    return wrapper
+
+########################################################################
+########################################################################
+#
+class PrometheusSink(object):
+    """
+    Keep running totals of the instrumented calls, per method, series and
+    cache result, and render them in the Prometheus text exposition
+    format (for instance from a /metrics view.)
+    """
+
+    COUNTERS = (
+        ('calls_total', 'Number of calls', None),
+        ('call_seconds_total', 'Wall time spent in calls', 'seconds'),
+        ('queries_total', 'Database queries made', 'queries'),
+        ('rows_scanned_total', 'Samples read', 'rows_scanned'),
+        ('rows_returned_total', 'Values returned', 'rows_returned'),
+        ('buckets_total', 'Buckets aggregated', 'buckets'),
+        )
+
+    ####################################################################
+    #
+    def __init__(self, prefix = "astimeseries"):
+        """
+        Arguments:
+        - `prefix`: prefix of the metric names
+        """
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    ####################################################################
+    #
+    def record(self, stats):
+        """
+        Add a call to the running totals
+
+        Arguments:
+        - `stats`: the CallStats of the call
+        """
+        key = (stats.method, stats.series, stats.cache or "none")
+        with self.lock:
+            totals = self.totals.setdefault(key, [0] * len(self.COUNTERS))
+            for i, (name, help, attr) in enumerate(self.COUNTERS):
+                totals[i] += 1 if attr is None else \
+                    (getattr(stats, attr) or 0)
+        return
+
+    ####################################################################
+    #
+    def render(self):
+        """
+        Return the running totals in the Prometheus text format
+        """
+        with self.lock:
+            items = sorted(self.totals.items())
+        lines = []
+        for i, (name, help, attr) in enumerate(self.COUNTERS):
+            metric = "%s_%s" % (self.prefix, name)
+            lines.append("# HELP %s %s" % (metric, help))
+            lines.append("# TYPE %s counter" % metric)
+            for (method, series, cache), totals in items:
+                lines.append('%s{method="%s",series="%s",cache="%s"} %s' %
+                             (metric, method, _escape(series), cache,
+                              totals[i]))
+        return "\n".join(lines) + "\n"
+
+####################################################################
+#
+def _escape(label):
+    return label.replace("\\", "\\\\").replace('"', '\\"').replace("\n",
+                                                                  "\\n")
+
+########################################################################
+########################################################################
+#
+class StatsdSink(object):
+    """
+    Send every instrumented call to a statsd server as a timer and a set of
+    counters:
+
+        <prefix>.<method>.time:<ms>|ms
+        <prefix>.<method>.queries:<n>|c
+        <prefix>.<method>.rows_scanned:<n>|c
+        <prefix>.<method>.rows_returned:<n>|c
+        <prefix>.<method>.buckets:<n>|c
+        <prefix>.<method>.cache.<hit|partial|miss>:1|c
+
+    The server defaults to settings.ASTIMESERIES_STATSD_HOST and
+    ASTIMESERIES_STATSD_PORT (localhost:8125.)
+    """
+
+    ####################################################################
+    #
+    def __init__(self, host = None, port = None, prefix = "astimeseries"):
+        """
+        Arguments:
+        - `host`: statsd host
+        - `port`: statsd UDP port
+        - `prefix`: prefix of the metric names
+        """
+        if host is None:
+            host = getattr(settings, "ASTIMESERIES_STATSD_HOST", "localhost")
+        if port is None:
+            port = getattr(settings, "ASTIMESERIES_STATSD_PORT", 8125)
+        self.addr = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    ####################################################################
+    #
+    def lines(self, stats):
+        """
+        The statsd lines for a call
+
+        Arguments:
+        - `stats`: the CallStats of the call
+        """
+        name = "%s.%s" % (self.prefix, stats.method)
+        lines = ["%s.time:%.3f|ms" % (name, stats.seconds * 1000)]
+        for attr in ('queries', 'rows_scanned', 'rows_returned', 'buckets'):
+            value = getattr(stats, attr)
+            if value is not None:
+                lines.append("%s.%s:%d|c" % (name, attr, value))
+        if stats.cache is not None:
+            lines.append("%s.cache.%s:1|c" % (name, stats.cache))
+        return lines
+
+    ####################################################################
+    #
+    def record(self, stats):
+        """
+        Send a call to the statsd server. Errors are ignored, metrics are
+        not worth failing a query over.
+
+        Arguments:
+        - `stats`: the CallStats of the call
+        """
+        try:
+            self.sock.sendto("\n".join(self.lines(stats)).encode("ascii"),
+                             self.addr)
+        except (socket.error, UnicodeError):
+            pass
+        return
@@ -9,16 +9,28 @@ Modes for the astimeseries django app
 # system imports
 #
 import decimal
+import heapq
+import itertools
+import math
+import threading
 
 # Django imports
 #
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
 # 3rd party improts
 #
 
+# Our imports
+#
+from astimeseries import aggregation, buffer, casting, codec, downsample
+from astimeseries import metrics, segments
+
 # Rounding factors. When doing various historical queries usually the caller is
 # going to want the buckets rounded to some nice factor.
 #
@@ -68,6 +80,36 @@ RANGES = (
     # 10 years
     )
 
+# The maximum number of samples packed in to a single DatumBlock when a
+# timeseries is sealed.
+#
+BLOCK_SIZE = 1024
+
+# history() queries that span at least this many seconds are aggregated in
+# parallel by settings.ASTIMESERIES_AGGREGATION_WORKERS threads.
+#
+PARALLEL_MIN_SPAN = 2592000 # 30 days
+
+# The pks of the timeseries that have had Datums saved in the transaction
+# in progress in this thread, and the on commit hook that touches them.
+#
+_touched = threading.local()
+
+# SQL for aggregating raw Datums in to buckets in the db, by db vendor (see
+# TimeSeries._db_partials()): the integer microseconds since the epoch of
+# a datetime column, the integer division operator and the value of a
+# string column as a float.
+#
+DB_AGGREGATION_SQL = {
+    'sqlite': ("(CAST(strftime('%%s', {0}) AS INTEGER) * 1000000 + "
+               "CAST(substr({0}, 21, 6) AS INTEGER))", "/",
+               "CAST({0} AS REAL)"),
+    'postgresql': ("CAST(ROUND(EXTRACT(EPOCH FROM {0}) * 1000000) AS BIGINT)",
+                   "/", "CAST({0} AS DOUBLE PRECISION)"),
+    'mysql': ("TIMESTAMPDIFF(MICROSECOND, '1970-01-01 00:00:00', {0})", "DIV",
+              "({0} + 0e0)"),
+    }
+
 ########################################################################
 ########################################################################
 #
@@ -138,7 +180,7 @@ class TimeSeries(models.Model):
         )
 
     FORMAT_CAST_FN = {
-        INT    : int,
+        INT    : casting.to_int,
         FLOAT  : float,
         DECIMAL: decimal.Decimal,
         RAW    : lambda x: x,
@@ -236,8 +278,10 @@ class TimeSeries(models.Model):
 
     ####################################################################
     #
+    @metrics.instrumented
     def history(self, frm = None, to = None, num_buckets = None,
-                bucket_size = None, aggr_fn = STDDEV):
+                bucket_size = None, aggr_fn = STDDEV, fill = None,
+                max_points = None, workers = None):
         """
         Get and aggregate the values in the time series between (and including)
         'frm' to 'to'. Group them either by the number of buckets asked for or
@@ -248,7 +292,9 @@ class TimeSeries(models.Model):
         method will try to decide an appropriate value mainly based on the date
         range specified.
 
-        The values will be cast to the 'fmt' (format) of the time series.
+        The values will be cast to the 'fmt' (format) of the time series,
+        except that the 'mean' and 'stddev' of an 'int' time series are
+        floats.
 
         The result will be of the format:
 
@@ -284,13 +330,44 @@ class TimeSeries(models.Model):
         - `aggr_fn`:     The type of function for aggregation of raw values in
                          to buckets. A string of 'min', 'max', 'first', 'last',
                          'stddev.' Defaults to 'stddev'
+        - `fill`:        How to fill buckets that have no samples in them.
+                         'None' (the default) only returns buckets that have
+                         samples. 'null' returns every bucket with None for
+                         the empty ones, 'previous' carries the last value
+                         forward, and 'linear' linearly interpolates between
+                         the values on either side of the gap.
+        - `max_points`:  If given, visually downsample the result to at most
+                         this many points with the Largest-Triangle-Three-
+                         Buckets algorithm (for instance the pixel width of
+                         the chart being drawn.) Empty buckets are dropped
+                         from the downsampled result.
+        - `workers`:     Split the range in to runs of whole buckets and
+                         aggregate them in parallel on this many threads,
+                         each with its own db connection, with the raw
+                         samples aggregated by the db itself. Defaults to
+                         settings.ASTIMESERIES_AGGREGATION_WORKERS (1) for
+                         ranges of at least PARALLEL_MIN_SPAN seconds.
+                         Ignored inside a transaction (the other
+                         connections can not see its writes) and on db
+                         backends we do not have the SQL for.
         """
 
         # make sure the caller specified a valid aggregation function.
         #
-        if aggr_fn not in SUPPORTED_AGG_FUNCTIONS:
-            raise ArgumentError(_("'%s' not a valid aggregation function") % \
-                                    aggr_fn)
+        if aggr_fn not in self.SUPPORTED_AGG_FUNCTIONS:
+            raise ValueError(_("'%s' not a valid aggregation function") % \
+                                 aggr_fn)
+        if num_buckets is not None and bucket_size is not None:
+            raise ValueError(_("You can specify either num_buckets or "
+                               "bucket_size, but not both"))
+        if num_buckets is not None and num_buckets < 1:
+            raise ValueError(_("num_buckets must be at least 1"))
+        if bucket_size is not None and bucket_size <= 0:
+            raise ValueError(_("bucket_size must be greater than 0"))
+        if fill is not None and fill not in aggregation.SUPPORTED_FILL_MODES:
+            raise ValueError(_("'%s' not a valid fill mode") % fill)
+        if max_points is not None and max_points < 3:
+            raise ValueError(_("max_points must be at least 3"))
 
         # If frm & to are both None then that means we need to fetch the entire
         # range of history values for this timeseries. That is easy enough, but
@@ -298,36 +375,251 @@ class TimeSeries(models.Model):
         # decide on an appropriate bucket size and to do that we need to know
         # the first and last timestamps of our time series.
         #
+        if frm is None or to is None:
+            first, last = self._bounds(frm, to)
+            if first is None:
+                return []
+            if frm is None:
+                frm = first
+            if to is None:
+                to = last
 
-        # Set up the filter to determine the range of values we are going to
-        # retrieve
+        start = aggregation.to_timestamp(frm)
+        end = aggregation.to_timestamp(to)
+
+        # If the caller did not give us an exact bucket size pick one based
+        # on the range being asked for and round the start of the range down
+        # to a multiple of it so the buckets land on nice boundaries.
         #
+        if bucket_size is None and num_buckets is None:
+            bucket_size = aggregation.pick_bucket_size(end - start, RANGES)
+            start = aggregation.align(start, bucket_size)
+        elif bucket_size is None:
+            # The grid includes 'to' so the buckets have to cover a little
+            # more than the span, or a span that divides evenly would get
+            # an extra bucket just for the samples at 'to'.
+            #
+            bucket_size = int(math.floor(float(end - start) /
+                                         num_buckets)) + 1
+
         # XXX part of what is going to happen here is to look at the date range
         #     and the bucket size and see if we have any cached series that
         #     match the bucket size and dates of cached series (and if they do
         #     only fetch values that are not already computed by the cached
         #     series)
         #
-        kwargs = {}
-        if frm is not None:
-            kwargs["time__gte", frm]
-        if to is not None:
-            kwargs["time__lte", to]
+        # We make a single pass over the raw values in the range, only
+        # producing buckets that have samples in them, and then lay those
+        # over the (computed, not queried) grid of every bucket in the range.
+        #
+        length = aggregation.grid_length(start, end, bucket_size)
+        metrics.record(buckets = length)
+        if workers is None:
+            workers = 1
+            if end - start >= PARALLEL_MIN_SPAN:
+                workers = getattr(settings,
+                                  "ASTIMESERIES_AGGREGATION_WORKERS", 1)
+        if workers > 1 and length > 1 and \
+                connection.vendor in DB_AGGREGATION_SQL and \
+                not connection.in_atomic_block:
+            buckets = self._parallel_accumulate(
+                start, to, bucket_size, length, workers,
+                aggr_fn in (self.FIRST, self.LAST))
+        else:
+            samples = ((t, float(v)) for t, when, v in
+                       self._samples(aggregation.from_timestamp(start), to))
+            buckets = aggregation.accumulate(samples, start, bucket_size)
+        sparse = [(idx, b.value(aggr_fn)) for idx, b in buckets]
+        result = aggregation.fill_grid(sparse, start, bucket_size, length,
+                                       fill)
+        if max_points is not None:
+            result = downsample.lttb(result, max_points)
 
+        # The mean or standard deviation of a bunch of integers is not an
+        # integer so those stay as floats.
+        #
+        values = [v for t, v in result]
+        if self.fmt != self.INT or aggr_fn not in (self.MEAN, self.STDDEV):
+            values = self.cast_many(values)
+        return [(aggregation.from_timestamp(t), v) for (t, x), v in
+                zip(result, values)]
 
+    ####################################################################
+    #
+    def _parallel_accumulate(self, start, to, bucket_size, length, workers,
+                             first_last):
+        """
+        Split the grid of `length` buckets beginning at `start` in to runs
+        of whole buckets, accumulate each run on a pool of `workers` threads
+        (each thread uses its own db connection) and merge the results.
 
+        The raw samples of each run are aggregated by the db (see
+        _db_partials()) so the threads spend their time waiting on the db,
+        not holding the GIL. Only samples packed in blocks or segment files
+        are accumulated in python.
 
-        return
+        Returns the sparse list of (bucket index, Bucket) tuples.
+
+        Arguments:
+        - `start`: posix timestamp of the first bucket
+        - `to`: datetime of the end of the range
+        - `bucket_size`: bucket size in seconds
+        - `length`: number of buckets in the grid
+        - `workers`: number of threads
+        - `first_last`: whether the buckets need their first and last values
+        """
+        # Several runs per thread so that one run that is dense with samples
+        # does not leave the other threads idle.
+        #
+        runs = aggregation.chunks(length, workers * 4)
+        start_us = int(round(start * 1000000))
+        size_us = int(round(bucket_size * 1000000))
+
+        def accumulate(run):
+            first, last = run
+            frm = aggregation.from_microseconds(start_us + first * size_us)
+            if last == length:
+                run_to = to
+            else:
+                run_to = aggregation.from_microseconds(start_us +
+                                                       last * size_us - 1)
+            try:
+                # Raw samples covered by the segment file are read from it
+                # along with the blocks, the rest are left to the db.
+                #
+                seg = self._segment()
+                raw_frm = frm
+                if seg is not None and \
+                        aggregation.to_microseconds(frm) <= seg.last:
+                    raw_frm = aggregation.from_microseconds(seg.last + 1)
+
+                samples = [0]
+                def counted():
+                    for t, when, v in self._samples(frm, run_to,
+                                                    raw = False):
+                        samples[0] += 1
+                        yield (t, float(v))
+                sparse = aggregation.accumulate(counted(), start,
+                                                bucket_size)
+                if raw_frm <= run_to:
+                    raw, n = self._db_partials(raw_frm, run_to, start_us,
+                                               size_us, first_last)
+                    sparse = aggregation.merge_sparse([sparse, raw])
+                    samples[0] += n
+                return (sparse, samples[0])
+            finally:
+                connection.close()
+
+        # Only loaded when we need it, multiprocessing is not cheap to
+        # import.
+        #
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(runs)))
+        try:
+            parts = pool.map(accumulate, runs)
+        finally:
+            pool.close()
+            pool.join()
+        metrics.record(rows_scanned = sum(n for part, n in parts))
+        return aggregation.merge_sparse(part for part, n in parts)
+
+    ####################################################################
+    #
+    def _db_partials(self, frm, to, start_us, size_us, first_last):
+        """
+        Aggregate the raw Datums between frm & to in to the buckets of the
+        grid that begins at `start_us` with one grouped query, returning
+        the count, sum, sum of squares, min and max (and first and last)
+        of every bucket without fetching the samples themselves.
+
+        Only the db vendors in DB_AGGREGATION_SQL are supported.
+
+        Returns (sparse list of (bucket index, Bucket) tuples, number of
+        samples.)
+
+        Arguments:
+        - `frm`: samples including this date forward
+        - `to`: samples up to and including this date
+        - `start_us`: microseconds since the epoch of the first bucket
+        - `size_us`: bucket size in microseconds
+        - `first_last`: also look up the first and last value of each
+                        bucket. If False they are left None.
+        """
+        epoch_us, div, to_float = DB_AGGREGATION_SQL[connection.vendor]
+        qn = connection.ops.quote_name
+        meta = Datum._meta
+        names = {
+            'table': qn(meta.db_table),
+            'id': qn(meta.pk.column),
+            'fk': qn(meta.get_field("timeseries").column),
+            'time': qn(meta.get_field("time").column),
+            'value': qn(meta.get_field("value").column),
+            }
+        names['us'] = epoch_us.format(names['time'])
+        names['float'] = to_float.format(names['value'])
+        names['div'] = div
+        if first_last:
+            names['first'] = ("(SELECT {value} FROM {table} WHERE {fk} = %s "
+                              "AND {time} = g.ft ORDER BY {id} LIMIT 1)"
+                              ).format(**names)
+            names['last'] = ("(SELECT {value} FROM {table} WHERE {fk} = %s "
+                             "AND {time} = g.lt ORDER BY {id} DESC LIMIT 1)"
+                             ).format(**names)
+            params = [self.pk, self.pk]
+        else:
+            names['first'] = names['last'] = "NULL"
+            params = []
+        sql = ("SELECT g.idx, g.n, g.s, g.ss, g.lo, g.hi, g.fus, g.lus, "
+               "{first}, {last} FROM ("
+               "SELECT ({us} - %s) {div} %s AS idx, COUNT(*) AS n, "
+               "SUM({float}) AS s, SUM({float} * {float}) AS ss, "
+               "MIN({float}) AS lo, MAX({float}) AS hi, "
+               "MIN({time}) AS ft, MAX({time}) AS lt, "
+               "MIN({us}) AS fus, MAX({us}) AS lus "
+               "FROM {table} WHERE {fk} = %s AND {time} >= %s "
+               "AND {time} <= %s GROUP BY idx) g ORDER BY g.idx"
+               ).format(**names)
+        params += [start_us, size_us, self.pk,
+                   connection.ops.adapt_datetimefield_value(frm),
+                   connection.ops.adapt_datetimefield_value(to)]
+
+        sparse = []
+        n = 0
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for idx, count, total, sumsq, lo, hi, fus, lus, first, last in \
+                    cursor.fetchall():
+                bucket = aggregation.Bucket()
+                bucket.count = count
+                bucket.sum = float(total)
+                bucket.sumsq = float(sumsq)
+                bucket.min = float(lo)
+                bucket.max = float(hi)
+                bucket.first_time = fus / 1e6
+                bucket.last_time = lus / 1e6
+                if first_last:
+                    bucket.first = float(first)
+                    bucket.last = float(last)
+                sparse.append((int(idx), bucket))
+                n += count
+        return (sparse, n)
 
     ####################################################################
     #
-    def raw_history(self, frm = None, to = None):
+    @metrics.instrumented
+    def raw_history(self, frm = None, to = None, max_points = None):
         """
         Return the raw history values in our timeseries between frm & to.
 
         The result is an array of tuples. Each tuple will be a (datetime,value)
         pair.
 
+        If `max_points` is given and there are more samples than that in the
+        range the samples are visually downsampled with the
+        Largest-Triangle-Three-Buckets algorithm. This makes two streaming
+        passes over the raw values in the db and never holds more than
+        `max_points` worth of state in memory.
+
         Arguments:
         - `frm`:         consider all samples including this date forward.
                          Defaults to 'None' which is the same as the earliest
@@ -335,12 +627,20 @@ class TimeSeries(models.Model):
         - `to`:          consider all samples up to and including this date.
                          Defaults to 'None' which is the same as the most
                          recent sample in the time series
+        - `max_points`:  downsample the result to at most this many samples.
+                         Defaults to 'None' which returns every sample.
         """
-        kwargs = {}
-        if frm is not None:
-            kwargs["time__gte", frm]
-        if to is not None:
-            kwargs["time__lte", to]
+        if max_points is not None:
+            if max_points < 3:
+                raise ValueError(_("max_points must be at least 3"))
+            if self.count(frm, to) > max_points:
+                first, last = self._bounds(frm, to)
+                def samples():
+                    for t, when, v in self._samples(frm, to):
+                        yield (t, float(v), (when, v))
+                return downsample.lttb_stream(
+                    samples, aggregation.to_timestamp(first),
+                    aggregation.to_timestamp(last), max_points)
 
         # Retrieve the values from the db and return them to the user
         #
@@ -350,10 +650,308 @@ class TimeSeries(models.Model):
         # XXX I am returning a list which actually fetches all values from the
         #     db. Maybe I should use an generator comprehension instead?
         #
-        return [(d.time,d.value) for d in self.data.filter(**kwargs)]
+        return [(when, v) for t, when, v in self._samples(frm, to)]
+
+    ####################################################################
+    #
+    def _samples(self, frm = None, to = None, raw = True):
+        """
+        A generator of every sample in this timeseries between frm & to,
+        in time order.
+
+        If this timeseries has a local segment file the part of the range
+        it covers is read from it and only the rest comes from the db.
+
+        Each sample is a (posix timestamp, datetime, value) tuple where the
+        value is a string, just as it would be stored in a Datum.
+
+        Arguments:
+        - `frm`: samples including this date forward, or None
+        - `to`:  samples up to and including this date, or None
+        - `raw`: if False the raw Datums in the db are skipped (the ones in
+                 the segment file are not.)
+        """
+        seg = self._segment()
+        if seg is None:
+            return metrics.counted(self._db_samples(frm, to, raw))
+
+        lo = None if frm is None else aggregation.to_microseconds(frm)
+        hi = None if to is None else aggregation.to_microseconds(to)
+        last = seg.last
+        def segmented():
+            for us, v in seg.samples(lo, last if hi is None else min(hi, last)):
+                yield (us / 1e6, aggregation.from_microseconds(us),
+                       self._packed_value(v))
+        if hi is not None and hi <= last:
+            metrics.record(cache = metrics.HIT)
+            return metrics.counted(segmented())
+        if lo is None or lo <= last:
+            metrics.record(cache = metrics.PARTIAL)
+            frm = aggregation.from_microseconds(last + 1)
+        else:
+            metrics.record(cache = metrics.MISS)
+        return metrics.counted(itertools.chain(segmented(),
+                                               self._db_samples(frm, to,
+                                                                raw)))
+
+    ####################################################################
+    #
+    def _db_samples(self, frm = None, to = None, raw = True):
+        """
+        Like _samples() but always reading from the db, whether the samples
+        are stored as raw Datums or packed in to DatumBlocks.
+
+        Arguments:
+        - `frm`: samples including this date forward, or None
+        - `to`:  samples up to and including this date, or None
+        - `raw`: if False only the samples packed in blocks are read
+        """
+        kwargs = {}
+        if frm is not None:
+            kwargs["time__gte"] = frm
+        if to is not None:
+            kwargs["time__lte"] = to
+        if raw:
+            raw = ((aggregation.to_timestamp(t), t, v) for t, v in
+                   self.data.filter(**kwargs).order_by("time").values_list(
+                       "time", "value").iterator())
+        else:
+            raw = iter(())
+
+        blocks = self._blocks(frm, to)
+        if not blocks.exists():
+            return raw
+
+        lo = None if frm is None else aggregation.to_microseconds(frm)
+        hi = None if to is None else aggregation.to_microseconds(to)
+        def packed():
+            for block in blocks.iterator():
+                for us, v in block.samples():
+                    if lo is not None and us < lo:
+                        continue
+                    if hi is not None and us > hi:
+                        return
+                    yield (us / 1e6, aggregation.from_microseconds(us),
+                           self._packed_value(v))
+
+        # Blocks never overlap each other so they are already in order, but
+        # raw samples older than the most recent block may still arrive.
+        #
+        return heapq.merge(packed(), raw)
+
+    ####################################################################
+    #
+    def _blocks(self, frm = None, to = None):
+        """
+        The DatumBlocks of this timeseries that overlap frm & to, in order.
+
+        Arguments:
+        - `frm`: blocks that end at or after this date, or None
+        - `to`:  blocks that start at or before this date, or None
+        """
+        blocks = self.blocks.order_by("start")
+        if frm is not None:
+            blocks = blocks.filter(end__gte = frm)
+        if to is not None:
+            blocks = blocks.filter(start__lte = to)
+        return blocks
 
     ####################################################################
     #
+    def _bounds(self, frm = None, to = None):
+        """
+        Return the (first, last) datetimes of the samples in this
+        timeseries between frm & to. Since blocks are not unpacked this
+        may be a little wider than the actual samples. Returns (None, None)
+        if there are no samples.
+
+        Arguments:
+        - `frm`: samples including this date forward, or None
+        - `to`:  samples up to and including this date, or None
+        """
+        kwargs = {}
+        if frm is not None:
+            kwargs["time__gte"] = frm
+        if to is not None:
+            kwargs["time__lte"] = to
+        raw = self.data.filter(**kwargs).aggregate(
+            first = models.Min("time"), last = models.Max("time"))
+        packed = self._blocks(frm, to).aggregate(
+            first = models.Min("start"), last = models.Max("end"))
+        firsts = [x for x in (raw["first"], packed["first"]) if x is not None]
+        lasts = [x for x in (raw["last"], packed["last"]) if x is not None]
+        if not firsts:
+            return (None, None)
+        first, last = min(firsts), max(lasts)
+        if frm is not None:
+            first = max(first, frm)
+        if to is not None:
+            last = min(last, to)
+        return (first, last)
+
+    ####################################################################
+    #
+    def _packed_value(self, value):
+        """
+        Format a float unpacked from a DatumBlock or segment file as the
+        string it would have been stored as in a Datum.
+
+        Arguments:
+        - `value`: the float
+        """
+        if self.fmt == self.INT:
+            return str(int(value))
+        return repr(value)
+
+    ####################################################################
+    #
+    def _packs_exactly(self, value):
+        """
+        True if the string value of a Datum comes back as the very same
+        string after being packed as a float (see _packed_value().) For
+        instance '2.5' in an int timeseries or '5' in a float one do not.
+
+        Arguments:
+        - `value`: the string value
+        """
+        try:
+            return self._packed_value(float(value)) == value
+        except (ValueError, OverflowError):
+            return False
+
+    ####################################################################
+    #
+    def _segment(self):
+        """
+        The local Segment for this timeseries, or None if the segment tier
+        is not enabled or this timeseries has not been exported.
+        """
+        if self.fmt not in (self.INT, self.FLOAT):
+            return None
+        path = segments.path_for(self)
+        if path is None:
+            return None
+        seg = segments.open_segment(path)
+        if seg is None:
+            metrics.record(cache = metrics.MISS)
+        return seg
+
+    ####################################################################
+    #
+    def export_segment(self, to):
+        """
+        Append the samples in this timeseries up to and including `to`
+        that are not already in its local segment file to the segment file
+        (see astimeseries.segments.) Only the finished part of a timeseries
+        should be exported since inserting a sample at or before the end of
+        the segment discards it.
+
+        Since the values are stored as floats the export stops at the first
+        sample whose value would not come back as exactly the same string
+        (see _packs_exactly().)
+
+        Returns the number of samples appended.
+
+        Arguments:
+        - `to`: export samples up to and including this date
+        """
+        path = segments.path_for(self)
+        if path is None:
+            raise ValueError(_("ASTIMESERIES_SEGMENT_DIR is not set"))
+        if self.fmt not in (self.INT, self.FLOAT):
+            raise ValueError(_("Only int and float timeseries can be "
+                               "exported"))
+        seg = segments.open_segment(path)
+        frm = None if seg is None else \
+            aggregation.from_microseconds(seg.last + 1)
+        def exact():
+            for t, when, v in self._db_samples(frm, to):
+                if not self._packs_exactly(v):
+                    return
+                yield (aggregation.to_microseconds(when), float(v))
+        return segments.append(path, exact())
+
+    ####################################################################
+    #
+    def seal(self, to):
+        """
+        Pack the raw samples in this timeseries up to and including `to` in
+        to compressed DatumBlocks of at most BLOCK_SIZE samples each, and
+        delete the raw Datum rows. raw_history(), history() and count() read
+        transparently across blocks and raw rows.
+
+        Only 'int' and 'float' timeseries can be sealed since the values
+        are packed as 64 bit floats.
+
+        Samples older than the most recent block are left as raw rows so
+        that blocks never overlap. So are samples whose value would not
+        come back as exactly the same string (see _packs_exactly()), for
+        instance the fractional values load_therms_from writes in to an int
+        timeseries.
+
+        Returns the number of blocks created.
+
+        Arguments:
+        - `to`: seal samples up to and including this date
+        """
+        if self.fmt not in (self.INT, self.FLOAT):
+            raise ValueError(_("Only int and float timeseries can be sealed"))
+
+        with transaction.atomic():
+            qs = self.data.filter(time__lte = to)
+            prev = self.blocks.order_by("-end").first()
+            if prev is not None:
+                qs = qs.filter(time__gt = prev.end)
+
+            blocks = []
+            sealed = []
+            chunk = []
+            for pk, t, v in qs.order_by("time").values_list(
+                    "id", "time", "value").iterator():
+                if not self._packs_exactly(v):
+                    continue
+                chunk.append((aggregation.to_microseconds(t), float(v)))
+                sealed.append(pk)
+                if len(chunk) == BLOCK_SIZE:
+                    blocks.append(DatumBlock.pack(self, chunk))
+                    chunk = []
+            if chunk:
+                blocks.append(DatumBlock.pack(self, chunk))
+            DatumBlock.objects.bulk_create(blocks)
+
+            # Only delete the rows that were packed, a few at a time to
+            # stay under the db's limit on query parameters. Moving them in
+            # to blocks does not change the samples so the segment file
+            # stays valid.
+            #
+            for i in range(0, len(sealed), 500):
+                self.data.filter(id__in = sealed[i:i + 500]).delete()
+            if blocks:
+                self.touch()
+        return len(blocks)
+
+    ####################################################################
+    #
+    def clear(self):
+        """
+        Delete every sample of this timeseries, raw and sealed in blocks,
+        with a bulk delete, and discard its segment file and any of its
+        samples still waiting in the ingest buffer.
+        """
+        self.data.all().delete()
+        self.blocks.all().delete()
+        self.touch()
+        path = segments.path_for(self)
+        if path is not None:
+            segments.discard(path)
+        buf = buffer.get_buffer()
+        if buf is not None:
+            buf.discard(self)
+        return
+
+    ####################################################################
+    #
+    @metrics.instrumented
     def insert(self, value, when = None):
         """
         Insert the given value to this time series.  You could just
@@ -364,6 +962,10 @@ class TimeSeries(models.Model):
 
         There is no return value.
 
+        If settings.ASTIMESERIES_INGEST_BUFFER is set the value is added to
+        the per process write-behind buffer (see astimeseries.buffer) and is
+        written to the db when the buffer is flushed.
+
         XXX We did not use 'append' because really you can add values anywhere
             in the time series.. it will almost always be at the end but there
             will be a number of times when it is not..
@@ -374,34 +976,88 @@ class TimeSeries(models.Model):
         """
         if when is None:
             when = now()
+
+        # If we have a write-behind buffer the sample will be written along
+        # with a bunch of others when the buffer is flushed.
+        #
+        buf = buffer.get_buffer()
+        if buf is not None:
+            buf.add(self, value, when)
+            return
+
+        # Saving the Datum discards our segment file if it is out of date
+        # and updates our watermark (see _datum_changed())
+        #
         self.data.create(time = when, value = value)
         return
 
     ####################################################################
     #
+    def _invalidate_segment(self, when):
+        """
+        A sample has been written at `when` without a Datum post_save
+        signal (for instance by a bulk insert.) If this lands inside our
+        local segment file the segment is out of date so discard it.
+
+        Arguments:
+        - `when`: the datetime of the earliest written sample
+        """
+        segments.invalidate(segments.path_for(self),
+                            aggregation.to_microseconds(when))
+        return
+
+    ####################################################################
+    #
+    @metrics.instrumented
     def current(self):
         """
-        Return the current value of this timeseries (node)
+        Return the current (most recent) value of this timeseries (node),
+        cast to its format, or None if it has no samples.
         """
-        return self.cast(self.data.all()[0])
+        latest = self.data.order_by("-time").values_list("time",
+                                                          "value").first()
+        block = self.blocks.order_by("-end").first()
+        if block is not None and (latest is None or block.end > latest[0]):
+            for us, v in block.samples():
+                pass
+            latest = (block.end, self._packed_value(v))
+        if latest is None:
+            return None
+        return self.cast(latest[1])
 
     ####################################################################
     #
     def cast(self, value):
         """
-        Convert the string value in to the value type (cls) for this time
-        series.
+        Convert the string value in to the value type (fmt) for this time
+        series. Decimal values are rounded to 'precision' digits after the
+        decimal point. This gives the same result as cast_many(), int
+        values are converted through a float.
+
+        Arguments:
+        - `value`: the value to convert
+        """
+        if self.fmt == self.DECIMAL:
+            return casting.to_decimal(value, self.precision)
+        return self.FORMAT_CAST_FN[self.fmt](value)
 
-        XXX We need to check if the cls is 'Decimal' and if it is call the cast
-            function with the precision context.
+    ####################################################################
+    #
+    def cast_many(self, values):
+        """
+        Convert a whole list of values in to the value type (fmt) for this
+        time series in one call. This is much cheaper than calling cast()
+        on each one (see astimeseries.casting.) None values are left as
+        None.
 
         Arguments:
-        - `value`:
+        - `values`: list of values to convert
         """
-        return FORMAT_CAST_FN[self.cls](value)
+        return casting.cast_many(values, self.fmt, self.precision)
 
     ####################################################################
     #
+    @metrics.instrumented
     def count(self, frm = None, to = None):
         """
         A shortcut to return the number of data in this timeseries.
@@ -412,12 +1068,85 @@ class TimeSeries(models.Model):
         - `when`: Count samples up to (and including) this date. If 'None'
                   then stop at the last sample in this timeseries
         """
+        seg = self._segment()
+        if seg is None:
+            return self._db_count(frm, to)
+        lo = None if frm is None else aggregation.to_microseconds(frm)
+        hi = None if to is None else aggregation.to_microseconds(to)
+        last = seg.last
+        start, stop = seg.span(lo, last if hi is None else min(hi, last))
+        if hi is not None and hi <= last:
+            metrics.record(cache = metrics.HIT)
+            return stop - start
+        if lo is None or lo <= last:
+            metrics.record(cache = metrics.PARTIAL)
+            frm = aggregation.from_microseconds(last + 1)
+        else:
+            metrics.record(cache = metrics.MISS)
+        return stop - start + self._db_count(frm, to)
+
+    ####################################################################
+    #
+    def _db_count(self, frm = None, to = None):
+        """
+        Like count() but always counting the samples in the db, whether
+        they are stored as raw Datums or packed in to DatumBlocks.
+
+        Arguments:
+        - `frm`: count samples including this date forward, or None
+        - `to`:  count samples up to and including this date, or None
+        """
         kwargs = {}
         if frm is not None:
-            kwargs["time__gte", frm]
+            kwargs["time__gte"] = frm
         if to is not None:
-            kwargs["time__lte", to]
-        return self.data.filter(**kwargs).count()
+            kwargs["time__lte"] = to
+        n = self.data.filter(**kwargs).count()
+
+        # Blocks that are entirely inside the range contribute their count,
+        # the ones that straddle an end of it have to be unpacked.
+        #
+        for block in self._blocks(frm, to):
+            if (frm is None or block.start >= frm) and \
+                    (to is None or block.end <= to):
+                n += block.count
+            else:
+                lo = None if frm is None else aggregation.to_microseconds(frm)
+                hi = None if to is None else aggregation.to_microseconds(to)
+                n += sum(1 for us, v in block.samples()
+                         if (lo is None or us >= lo) and
+                         (hi is None or us <= hi))
+        return n
+
+    ####################################################################
+    #
+    def watermark(self):
+        """
+        Return a tuple that changes whenever samples are added to or
+        removed from this timeseries (or its format changes) without any
+        db queries at all, from the 'updated' time of this instance. Used
+        to tell if the results of a previous query are still valid (for
+        instance for HTTP ETags.)
+
+        NOTE: Saving a Datum (including through insert()), the ingest
+              buffer, seal(), clear() and loading a snapshot all update the
+              watermark. Deleting Datums with a queryset delete() does not
+              (use clear()), nor do bulk_create() or update() of Datums
+              outside of this app.
+        """
+        return (self.pk, self.fmt, self.precision, self.updated)
+
+    ####################################################################
+    #
+    def touch(self):
+        """
+        Set 'updated' to now, marking the samples of this timeseries as
+        changed (see watermark()), with a single UPDATE that writes no
+        other field.
+        """
+        self.updated = now()
+        TimeSeries.objects.filter(pk = self.pk).update(updated = self.updated)
+        return
 
     ####################################################################
     #
@@ -458,3 +1187,137 @@ class Datum(models.Model):
     def __unicode__(self):
         return u"%s(%s@'%s')" % (self.timeseries.name, self.value,
                                         self.time)
+
+########################################################################
+########################################################################
+#
+class DatumBlock(models.Model):
+    """
+    A sealed, contiguous run of samples of a timeseries packed in to a
+    single compressed blob (see astimeseries.codec.) Timestamps are stored
+    as delta-of-deltas and values as XOR'd floats so a block of regularly
+    sampled, slowly changing values takes a bit or two per sample instead
+    of a whole Datum row.
+
+    Blocks are created by TimeSeries.seal() and never overlap.
+    """
+    timeseries = models.ForeignKey(TimeSeries,
+                                   verbose_name = _('time series'),
+                                   help_text = _('Time series this block '
+                                                 'belongs to'),
+                                   related_name = 'blocks')
+    start = models.DateTimeField(_('start'), db_index = True,
+                                 help_text = _('The time of the first sample '
+                                               'in this block'))
+    end = models.DateTimeField(_('end'), db_index = True,
+                               help_text = _('The time of the last sample '
+                                             'in this block'))
+    count = models.IntegerField(_('count'),
+                                help_text = _('The number of samples in '
+                                              'this block'))
+    data = models.BinaryField(_('data'),
+                              help_text = _('The compressed samples'))
+
+    class Meta:
+        ordering = ("timeseries","start")
+
+    ####################################################################
+    #
+    @classmethod
+    def pack(cls, timeseries, samples):
+        """
+        Return a new (unsaved) block holding the given samples.
+
+        Arguments:
+        - `timeseries`: the TimeSeries the block belongs to
+        - `samples`: list of (integer microseconds, float) tuples in order
+        """
+        return cls(timeseries = timeseries,
+                   start = aggregation.from_microseconds(samples[0][0]),
+                   end = aggregation.from_microseconds(samples[-1][0]),
+                   count = len(samples),
+                   data = codec.encode(samples))
+
+    ####################################################################
+    #
+    def samples(self):
+        """
+        A generator of the (integer microseconds, float) samples in this
+        block.
+        """
+        return codec.decode(self.data)
+
+    ####################################################################
+    #
+    def __unicode__(self):
+        return u"%s(%d@'%s'-'%s')" % (self.timeseries.name, self.count,
+                                      self.start, self.end)
+
+####################################################################
+#
+@receiver(post_save, sender = TimeSeries)
+@receiver(post_delete, sender = TimeSeries)
+def _timeseries_changed(sender, instance, **kwargs):
+    """
+    When a timeseries is created or deleted discard any segment file left
+    for its pk, so a new timeseries that reuses the pk of a deleted one
+    does not read its samples.
+    """
+    if kwargs.get("created", True):
+        path = segments.path_for(instance)
+        if path is not None:
+            segments.discard(path)
+    return
+
+####################################################################
+#
+# NOTE: There are deliberately no delete receivers for Datum and
+#       DatumBlock. Any delete receiver makes django select every row in to
+#       memory before deleting it instead of issuing a single bulk DELETE.
+#       Deletes go through TimeSeries.clear() or delete the whole
+#       TimeSeries instead.
+#
+@receiver(post_save, sender = Datum)
+def _datum_changed(sender, instance, **kwargs):
+    """
+    A Datum was written, by TimeSeries.insert() or directly. If it is
+    inside the segment file of its timeseries the segment is discarded, and
+    the timeseries is touched (see _touch_on_commit().)
+    """
+    segments.invalidate(segments.path_for(instance.timeseries_id),
+                        aggregation.to_microseconds(instance.time))
+    _touch_on_commit(instance.timeseries_id)
+    return
+
+####################################################################
+#
+def _touch_on_commit(pk):
+    """
+    Set 'updated' of the timeseries with the given pk to now (see
+    TimeSeries.touch().) Outside of a transaction this is done straight
+    away. Inside one it is done when the transaction commits, with one
+    UPDATE for every timeseries touched in it, so saving a lot of Datums
+    in a transaction does not cost an UPDATE each.
+
+    Arguments:
+    - `pk`: the pk of the TimeSeries
+    """
+    if not connection.in_atomic_block:
+        TimeSeries.objects.filter(pk = pk).update(updated = now())
+        return
+
+    # If the transaction (or the savepoint) our hook was registered in
+    # was rolled back django has dropped the hook, so start over.
+    #
+    hook = getattr(_touched, "hook", None)
+    if hook is None or \
+            not any(fn is hook for sids, fn in connection.run_on_commit):
+        pks = set()
+        def hook():
+            _touched.hook = None
+            TimeSeries.objects.filter(pk__in = pks).update(updated = now())
+        hook.pks = pks
+        _touched.hook = hook
+        transaction.on_commit(hook)
+    hook.pks.add(pk)
+    return
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+A read-through tier of local, memory mapped segment files.
+
+If settings.ASTIMESERIES_SEGMENT_DIR is set, the finished part of a
+timeseries can be exported (TimeSeries.export_segment()) to an append-only
+file in that directory. Every sample is a fixed width record of a little
+endian int64 (microseconds since the epoch) and a float64. Next to it is a
+sparse index file holding the time of every INDEX_INTERVAL'th record.
+
+Reads mmap the files and binary search them, first in the index and then
+in the window of records it points at, so the part of a query that the
+segment covers needs no db round trip at all. Since the files are mapped
+read-only every worker process on a host shares the one page cached copy.
+
+The db stays authoritative. If a sample at or before the end of a segment
+is written - whether through TimeSeries.insert(), the ingest buffer, a
+snapshot load or by saving a Datum directly - the segment is discarded and
+has to be exported again. So is the segment of a timeseries whose samples
+are deleted with TimeSeries.clear(). When a timeseries is created or
+deleted any segment file left for its pk is discarded too, so a reused pk
+never picks up another series' samples.
+
+NOTE: Writes that bypass the model (raw SQL, queryset update() or delete()
+      or a bulk_create() of Datums outside of this app) are not seen.
+      Discard the segment yourself with discard().
+"""
+
+# system imports
+#
+import mmap
+import os
+import struct
+
+# django imports
+#
+from django.conf import settings
+
+RECORD = struct.Struct("<qd")
+INDEX = struct.Struct("<q")
+INDEX_INTERVAL = 1024
+
+# Segments this process has open, by path.
+#
+_open_segments = {}
+
+####################################################################
+#
+def segment_dir():
+    """
+    The directory segment files live in, or None if the segment tier is
+    not enabled.
+    """
+    return getattr(settings, "ASTIMESERIES_SEGMENT_DIR", None)
+
+####################################################################
+#
+def path_for(timeseries):
+    """
+    The path of the segment file for the given timeseries, or None if
+    the segment tier is not enabled.
+
+    Arguments:
+    - `timeseries`: a TimeSeries, or its pk
+    """
+    directory = segment_dir()
+    if directory is None:
+        return None
+    return os.path.join(directory,
+                        "%d.seg" % getattr(timeseries, "pk", timeseries))
+
+########################################################################
+########################################################################
+#
+class Segment(object):
+    """
+    A read-only, memory mapped segment file and its sparse index.
+    """
+
+    ####################################################################
+    #
+    def __init__(self, path):
+        """
+        Arguments:
+        - `path`: path of the segment file
+        """
+        self.path = path
+        self.stat = os.stat(path)
+        self.data = self._map(path)
+        self.count = self.stat.st_size // RECORD.size
+        self.index = self._map(path + ".idx")
+        self.nindex = len(self.index) // INDEX.size if self.index else 0
+
+    ####################################################################
+    #
+    @staticmethod
+    def _map(path):
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except (IOError, OSError):
+            return None
+
+    ####################################################################
+    #
+    def close(self):
+        """
+        Unmap the segment
+        """
+        for m in (self.data, self.index):
+            if m is not None:
+                m.close()
+        self.data = self.index = None
+        return
+
+    ####################################################################
+    #
+    def time_at(self, i):
+        """
+        The time (microseconds) of the i'th record
+        """
+        return RECORD.unpack_from(self.data, i * RECORD.size)[0]
+
+    ####################################################################
+    #
+    @property
+    def first(self):
+        return self.time_at(0) if self.count else None
+
+    ####################################################################
+    #
+    @property
+    def last(self):
+        return self.time_at(self.count - 1) if self.count else None
+
+    ####################################################################
+    #
+    def bisect(self, us, right = False):
+        """
+        The index of the first record whose time is >= `us` (or > `us` if
+        `right` is True.)
+
+        Arguments:
+        - `us`: time in microseconds
+        - `right`: skip records whose time is equal to `us`
+        """
+        # Narrow down to the window between two index entries.
+        #
+        lo, hi = 0, self.nindex
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = INDEX.unpack_from(self.index, mid * INDEX.size)[0]
+            if t < us or (right and t == us):
+                lo = mid + 1
+            else:
+                hi = mid
+        # The index may lag behind the records if we caught a writer in the
+        # middle of an append, so past the last index entry we search to
+        # the end of the records.
+        #
+        if lo == self.nindex:
+            hi = self.count
+        else:
+            hi = min(lo * INDEX_INTERVAL, self.count)
+        lo = max(lo - 1, 0) * INDEX_INTERVAL
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = self.time_at(mid)
+            if t < us or (right and t == us):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    ####################################################################
+    #
+    def span(self, lo = None, hi = None):
+        """
+        The (start, stop) record indices of the records whose time is
+        between `lo` and `hi` inclusive.
+
+        Arguments:
+        - `lo`: microseconds, or None for the start of the segment
+        - `hi`: microseconds, or None for the end of the segment
+        """
+        start = 0 if lo is None else self.bisect(lo)
+        stop = self.count if hi is None else self.bisect(hi, right = True)
+        return (start, max(start, stop))
+
+    ####################################################################
+    #
+    def samples(self, lo = None, hi = None):
+        """
+        A generator of the (microseconds, float) records whose time is
+        between `lo` and `hi` inclusive.
+
+        Arguments:
+        - `lo`: microseconds, or None for the start of the segment
+        - `hi`: microseconds, or None for the end of the segment
+        """
+        start, stop = self.span(lo, hi)
+        unpack, data, size = RECORD.unpack_from, self.data, RECORD.size
+        for i in range(start, stop):
+            yield unpack(data, i * size)
+        return
+
+####################################################################
+#
+def open_segment(path):
+    """
+    Return the Segment for the given path, or None if there is no such
+    file. Segments are kept open in this process and re-opened if the file
+    has been appended to or replaced.
+
+    Arguments:
+    - `path`: path of the segment file
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        seg = _open_segments.pop(path, None)
+        if seg is not None:
+            seg.close()
+        return None
+    seg = _open_segments.get(path)
+    if seg is not None:
+        if seg.stat.st_ino == st.st_ino and seg.stat.st_size == st.st_size:
+            return seg
+        seg.close()
+    seg = Segment(path)
+    if seg.count == 0:
+        seg.close()
+        _open_segments.pop(path, None)
+        return None
+    _open_segments[path] = seg
+    return seg
+
+####################################################################
+#
+def append(path, samples):
+    """
+    Append (microseconds, float) samples, in time order and all later
+    than the last sample already in the segment, to the segment file.
+    Returns the number of samples appended.
+
+    Arguments:
+    - `path`: path of the segment file
+    - `samples`: iterable of (int, float) tuples
+    """
+    try:
+        count = os.stat(path).st_size // RECORD.size
+    except OSError:
+        count = 0
+    n = 0
+    with open(path, "ab") as data:
+        with open(path + ".idx", "ab") as index:
+            for us, value in samples:
+                data.write(RECORD.pack(us, value))
+                if (count + n) % INDEX_INTERVAL == 0:
+                    index.write(INDEX.pack(us))
+                n += 1
+    return n
+
+####################################################################
+#
+def invalidate(path, us):
+    """
+    A sample at `us` has been written or deleted. If that is at or before
+    the end of the segment file at `path` the segment is out of date, so
+    discard it.
+
+    Arguments:
+    - `path`: path of the segment file, or None
+    - `us`: time of the sample in microseconds since the epoch
+    """
+    if path is not None:
+        seg = open_segment(path)
+        if seg is not None and us <= seg.last:
+            discard(path)
+    return
+
+####################################################################
+#
+def discard(path):
+    """
+    Remove a segment file and its index.
+
+    Arguments:
+    - `path`: path of the segment file
+    """
+    seg = _open_segments.pop(path, None)
+    if seg is not None:
+        seg.close()
+    for p in (path, path + ".idx"):
+        try:
+            os.unlink(p)
+        except OSError:
+            pass
+    return
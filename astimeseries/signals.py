@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Signals sent by the astimeseries app
+"""
+
+# django imports
+#
+from django.dispatch import Signal
+
+# Sent after each instrumented TimeSeries call (raw_history(), history(),
+# insert(), count() and current()) returns. The sender is the TimeSeries
+# class, 'timeseries' is the instance and 'stats' is the
+# astimeseries.metrics.CallStats for the call.
+#
+call_finished = Signal(providing_args = ["timeseries", "stats"])
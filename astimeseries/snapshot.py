@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+A compact binary snapshot format for moving timeseries and their samples
+between environments (see the dump_timeseries and load_timeseries
+management commands.) It is read and written in streaming chunks so
+neither side ever holds a whole series in memory.
+
+All integers are little endian. A snapshot is:
+
+    magic 'ASTS', version (1 byte)
+
+followed by any number of series:
+
+    'S', name length (4 bytes), name (utf-8), fmt (3 bytes),
+    cls (3 bytes), precision (2 bytes)
+
+each followed by any number of chunks of samples:
+
+    count (4 bytes), payload length (4 bytes), value kind (1 byte),
+    compressed (1 byte), payload
+
+and a chunk with a count of 0 to end the series. The snapshot ends with
+'E'.
+
+The (optionally zlib compressed) payload is the count int64 sample
+times in microseconds since the epoch followed by the values as count
+int64s (kind 'i'), count float64s (kind 'f'), or count uint32 lengths
+followed by the utf-8 strings (kind 's'.) A chunk is only packed as ints
+or floats if every value in it turns back in to exactly the same string,
+so a snapshot always restores the very same Datum values.
+"""
+
+# system imports
+#
+import struct
+import zlib
+
+# django imports
+#
+from django.db import transaction
+
+# Our imports
+#
+from astimeseries import aggregation
+from astimeseries.models import TimeSeries, Datum
+
+MAGIC = b"ASTS"
+VERSION = 1
+SERIES = struct.Struct("<cI")
+SERIES_META = struct.Struct("<3s3sh")
+CHUNK = struct.Struct("<IIcB")
+
+INTS = b"i"
+FLOATS = b"f"
+STRINGS = b"s"
+
+CHUNK_SIZE = 10000
+
+########################################################################
+########################################################################
+#
+class SnapshotError(Exception):
+    """
+    Raised when reading something that is not a valid snapshot
+    """
+    pass
+
+####################################################################
+#
+def _pack_values(values, fmt):
+    """
+    Pack a chunk of string values, as ints or floats if the timeseries
+    format calls for it and they survive the round trip, otherwise as
+    strings. Returns (kind, bytes).
+    """
+    n = len(values)
+    try:
+        if fmt == TimeSeries.INT:
+            ints = [int(v) for v in values]
+            if all(str(i) == v for i, v in zip(ints, values)):
+                return INTS, struct.pack("<%dq" % n, *ints)
+        elif fmt == TimeSeries.FLOAT:
+            floats = [float(v) for v in values]
+            if all(repr(f) == v for f, v in zip(floats, values)):
+                return FLOATS, struct.pack("<%dd" % n, *floats)
+    except (ValueError, struct.error):
+        pass
+    encoded = [v.encode("utf-8") for v in values]
+    return STRINGS, struct.pack("<%dI" % n, *[len(e) for e in encoded]) + \
+        b"".join(encoded)
+
+####################################################################
+#
+def _unpack_values(kind, data, n):
+    """
+    The inverse of _pack_values()
+    """
+    if kind == INTS:
+        return [str(i) for i in struct.unpack_from("<%dq" % n, data)]
+    elif kind == FLOATS:
+        return [repr(f) for f in struct.unpack_from("<%dd" % n, data)]
+    elif kind == STRINGS:
+        lengths = struct.unpack_from("<%dI" % n, data)
+        values = []
+        pos = 4 * n
+        for length in lengths:
+            values.append(data[pos:pos + length].decode("utf-8"))
+            pos += length
+        return values
+    raise SnapshotError("unknown value kind %r" % kind)
+
+####################################################################
+#
+def _write_chunk(out, chunk, fmt, compress):
+    times = struct.pack("<%dq" % len(chunk), *[t for t, v in chunk])
+    kind, values = _pack_values([v for t, v in chunk], fmt)
+    payload = times + values
+    if compress:
+        payload = zlib.compress(payload)
+    out.write(CHUNK.pack(len(chunk), len(payload), kind, int(compress)))
+    out.write(payload)
+    return
+
+####################################################################
+#
+def dump(out, queryset, compress = False, chunk_size = CHUNK_SIZE):
+    """
+    Write a snapshot of the timeseries in `queryset` and all of their
+    samples (raw and sealed in blocks) to the binary file `out`. Returns
+    the (number of series, number of samples) written.
+
+    Arguments:
+    - `out`: file object opened for binary writing
+    - `queryset`: the TimeSeries to dump
+    - `compress`: zlib compress each chunk of samples
+    - `chunk_size`: how many samples to write per chunk
+    """
+    out.write(MAGIC + struct.pack("<B", VERSION))
+    nseries = nsamples = 0
+    for t in queryset.iterator():
+        name = t.name.encode("utf-8")
+        out.write(SERIES.pack(b"S", len(name)) + name)
+        out.write(SERIES_META.pack(t.fmt.encode("ascii"),
+                                   t.cls.encode("ascii"), t.precision))
+        chunk = []
+        for ts, when, value in t._db_samples():
+            chunk.append((aggregation.to_microseconds(when), value))
+            if len(chunk) == chunk_size:
+                _write_chunk(out, chunk, t.fmt, compress)
+                nsamples += len(chunk)
+                chunk = []
+        if chunk:
+            _write_chunk(out, chunk, t.fmt, compress)
+            nsamples += len(chunk)
+        out.write(CHUNK.pack(0, 0, STRINGS, 0))
+        nseries += 1
+    out.write(b"E")
+    return (nseries, nsamples)
+
+####################################################################
+#
+def _read(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise SnapshotError("snapshot is truncated")
+    return data
+
+####################################################################
+#
+def load(f, replace = False):
+    """
+    Restore the timeseries in the snapshot in the binary file `f`. Each
+    timeseries is restored in its own transaction. If a timeseries with the
+    same name already exists SnapshotError is raised, unless `replace` is
+    True in which case its samples are deleted first, along with its
+    segment file and any of its samples waiting in the ingest buffer.
+    Returns the (number of series, number of samples) restored.
+
+    Arguments:
+    - `f`: file object opened for binary reading
+    - `replace`: replace the samples of existing timeseries
+    """
+    if _read(f, len(MAGIC)) != MAGIC:
+        raise SnapshotError("not a timeseries snapshot")
+    version = struct.unpack("<B", _read(f, 1))[0]
+    if version != VERSION:
+        raise SnapshotError("unknown snapshot version %d" % version)
+
+    nseries = nsamples = 0
+    while True:
+        tag = _read(f, 1)
+        if tag == b"E":
+            break
+        if tag != b"S":
+            raise SnapshotError("bad series tag %r" % tag)
+        length = struct.unpack("<I", _read(f, 4))[0]
+        name = _read(f, length).decode("utf-8")
+        fmt, cls, precision = SERIES_META.unpack(_read(f, SERIES_META.size))
+
+        with transaction.atomic():
+            t = TimeSeries.objects.filter(name = name).first()
+            if t is not None:
+                if not replace:
+                    raise SnapshotError("timeseries '%s' already exists" %
+                                        name)
+                t.clear()
+            else:
+                t = TimeSeries(name = name)
+            t.fmt = fmt.decode("ascii")
+            t.cls = cls.decode("ascii")
+            t.precision = precision
+            t.save()
+
+            while True:
+                n, size, kind, compressed = CHUNK.unpack(_read(f, CHUNK.size))
+                if n == 0:
+                    break
+                payload = _read(f, size)
+                if compressed:
+                    payload = zlib.decompress(payload)
+                times = struct.unpack_from("<%dq" % n, payload)
+                values = _unpack_values(kind, payload[8 * n:], n)
+                Datum.objects.bulk_create(
+                    [Datum(timeseries = t,
+                           time = aggregation.from_microseconds(us),
+                           value = v) for us, v in zip(times, values)])
+                nsamples += n
+        nseries += 1
+    return (nseries, nsamples)
@@ -5,12 +5,26 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 import datetime
+import decimal
+import json
+import os.path
+import shutil
+import socket
+import tempfile
 
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test.utils import CaptureQueriesContext, override_settings
 
 from django.utils.timezone import now, utc
 from django.utils.encoding import smart_str
+from django.utils.six import StringIO
 from astimeseries.models import TimeSeries, Datum
+from astimeseries import aggregation, benchmarks, buffer, casting, metrics
+from astimeseries import segments, snapshot
+from astimeseries.signals import call_finished
 
 ####################################################################
 #
@@ -108,3 +122,1028 @@ class BasicTimeSeries(TestCase):
         """
         """
         return
+
+    ####################################################################
+    #
+    def test_history_buckets(self):
+        """
+        Test aggregating the series in to fixed size buckets
+        """
+        t = TimeSeries.objects.get(name = "test")
+        d = t.history(bucket_size = 20, aggr_fn = TimeSeries.MAX)
+        self.assertEqual([x[0] for x in d], [pt(x) for x in range(0,100,20)])
+        self.assertEqual([x[1] for x in d], [15, 35, 55, 75, 95])
+        d = t.history(bucket_size = 20, aggr_fn = TimeSeries.MEAN)
+        self.assertEqual([x[1] for x in d], [7.5, 27.5, 47.5, 67.5, 87.5])
+        d = t.history(frm = pt(20), to = pt(39), bucket_size = 10,
+                      aggr_fn = TimeSeries.FIRST)
+        self.assertEqual(d, [(pt(20), 20), (pt(30), 30)])
+
+        # Never more than num_buckets buckets, even when the span divides
+        # evenly
+        #
+        self.assertEqual(len(t.history(num_buckets = 5, fill = "null")), 5)
+        self.assertEqual(len(t.history(frm = pt(0), to = pt(100),
+                                       num_buckets = 10, fill = "null")), 10)
+        for kwargs in ({"bucket_size": 0}, {"bucket_size": -5},
+                       {"num_buckets": 0}):
+            self.assertRaises(ValueError, t.history, **kwargs)
+        return
+
+########################################################################
+########################################################################
+#
+class GapFilling(TestCase):
+    """
+    Test filling in the buckets of history() results that have no samples
+    """
+
+    ####################################################################
+    #
+    def setUp(self):
+        """
+        A series with samples at 0, 10, and 40 seconds, leaving the 20 and
+        30 second buckets empty.
+        """
+        t = TimeSeries(name = "sparse")
+        t.save()
+        for x in (0, 10, 40):
+            t.insert(x, pt(x))
+        return
+
+    ####################################################################
+    #
+    def test_fill_modes(self):
+        """
+        Each fill mode produces a point for every bucket on the grid
+        """
+        t = TimeSeries.objects.get(name = "sparse")
+        kw = dict(bucket_size = 10, aggr_fn = TimeSeries.MEAN)
+        d = t.history(**kw)
+        self.assertEqual([x[1] for x in d], [0, 10, 40])
+        d = t.history(fill = 'null', **kw)
+        self.assertEqual([x[0] for x in d], [pt(x) for x in range(0,50,10)])
+        self.assertEqual([x[1] for x in d], [0, 10, None, None, 40])
+        d = t.history(fill = 'previous', **kw)
+        self.assertEqual([x[1] for x in d], [0, 10, 10, 10, 40])
+        d = t.history(fill = 'linear', **kw)
+        self.assertEqual([x[1] for x in d], [0, 10, 20, 30, 40])
+        d = t.history(frm = pt(0), to = pt(60), fill = 'linear', **kw)
+        self.assertEqual([x[1] for x in d], [0, 10, 20, 30, 40, None, None])
+        self.assertRaises(ValueError, t.history, fill = 'bogus')
+        return
+
+########################################################################
+########################################################################
+#
+class Downsampling(TestCase):
+    """
+    Test the Largest-Triangle-Three-Buckets downsampling of history
+    """
+
+    ####################################################################
+    #
+    def setUp(self):
+        """
+        A flat series of 100 samples with a single spike in it
+        """
+        t = TimeSeries(name = "spike")
+        t.save()
+        for x in range(100):
+            t.insert(50 if x == 37 else 0, pt(x))
+        return
+
+    ####################################################################
+    #
+    def test_raw_history_max_points(self):
+        """
+        The first, last and the spike survive the downsampling
+        """
+        t = TimeSeries.objects.get(name = "spike")
+        raw = t.raw_history(max_points = 10)
+        self.assertTrue(len(raw) <= 10)
+        self.assertEqual(raw[0][0], pt(0))
+        self.assertEqual(raw[-1][0], pt(99))
+        self.assertTrue((pt(37), "50") in raw)
+        self.assertEqual(len(t.raw_history(max_points = 100)), 100)
+        self.assertRaises(ValueError, t.raw_history, max_points = 2)
+        return
+
+    ####################################################################
+    #
+    def test_history_max_points(self):
+        """
+        Downsampling the bucketed history keeps the spike bucket
+        """
+        t = TimeSeries.objects.get(name = "spike")
+        d = t.history(bucket_size = 2, aggr_fn = TimeSeries.MAX,
+                      max_points = 5)
+        self.assertTrue(len(d) <= 5)
+        self.assertTrue((pt(36), 50) in d)
+        return
+
+########################################################################
+########################################################################
+#
+class BlockStorage(TestCase):
+    """
+    Test sealing raw samples in to compressed DatumBlocks
+    """
+
+    ####################################################################
+    #
+    def setUp(self):
+        """
+        A float series of 3000 regularly spaced samples
+        """
+        t = TimeSeries(name = "blocks", fmt = TimeSeries.FLOAT)
+        t.save()
+        Datum.objects.bulk_create([Datum(timeseries = t, time = pt(x * 5),
+                                         value = repr(70.0 + (x % 7) * 0.25))
+                                   for x in range(3000)])
+        return
+
+    ####################################################################
+    #
+    def test_seal(self):
+        """
+        Reads are the same before and after sealing part of the series
+        """
+        t = TimeSeries.objects.get(name = "blocks")
+        raw = t.raw_history()
+        hist = t.history(bucket_size = 600, aggr_fn = TimeSeries.MEAN)
+        ranged = t.raw_history(frm = pt(4000), to = pt(6000))
+
+        self.assertEqual(t.seal(pt(11000)), 3)
+        self.assertEqual(t.blocks.count(), 3)
+        self.assertEqual(t.data.count(), 3000 - 2201)
+        self.assertEqual(t.count(), 3000)
+        self.assertEqual(t.count(frm = pt(4000), to = pt(6000)), 401)
+        self.assertEqual(t.raw_history(), raw)
+        self.assertEqual(t.raw_history(frm = pt(4000), to = pt(6000)), ranged)
+        self.assertEqual(t.history(bucket_size = 600,
+                                   aggr_fn = TimeSeries.MEAN), hist)
+
+        # Samples that arrive for already sealed times are merged in.
+        #
+        t.insert(repr(1.5), pt(7))
+        self.assertEqual(t.raw_history(to = pt(10)),
+                         [(pt(0), "70.0"), (pt(5), "70.25"), (pt(7), "1.5"),
+                          (pt(10), "70.5")])
+        self.assertEqual(t.seal(pt(11000)), 0)
+        return
+
+    ####################################################################
+    #
+    def test_seal_raw(self):
+        """
+        Only int and float timeseries can be sealed
+        """
+        t = TimeSeries(name = "raw", fmt = TimeSeries.RAW)
+        t.save()
+        self.assertRaises(ValueError, t.seal, pt(0))
+        return
+
+    ####################################################################
+    #
+    def test_seal_inexact(self):
+        """
+        Values that would not come back as the same string stay raw rows
+        """
+        t = TimeSeries(name = "inexact")
+        t.save()
+        for x, v in enumerate(("1", "2.5", "3", "007", "4")):
+            t.data.create(time = pt(x), value = v)
+        self.assertEqual(t.seal(pt(10)), 1)
+        self.assertEqual(t.blocks.get().count, 3)
+        self.assertEqual(sorted(t.data.values_list("value", flat = True)),
+                         ["007", "2.5"])
+        self.assertEqual([v for when, v in t.raw_history()],
+                         ["1", "2.5", "3", "007", "4"])
+
+        t = TimeSeries.objects.get(name = "blocks")
+        t.data.filter(time = pt(5)).update(value = "5")
+        t.seal(pt(10))
+        self.assertEqual(t.raw_history(to = pt(10)),
+                         [(pt(0), "70.0"), (pt(5), "5"), (pt(10), "70.5")])
+        return
+
+########################################################################
+########################################################################
+#
+class SegmentFiles(TestCase):
+    """
+    Test the memory mapped segment file read-through tier
+    """
+
+    ####################################################################
+    #
+    def setUp(self):
+        """
+        A float series of 3000 regularly spaced samples and a directory to
+        put segment files in.
+        """
+        self.dir = tempfile.mkdtemp()
+        self.settings = override_settings(ASTIMESERIES_SEGMENT_DIR = self.dir)
+        self.settings.enable()
+        t = TimeSeries(name = "segments", fmt = TimeSeries.FLOAT)
+        t.save()
+        Datum.objects.bulk_create([Datum(timeseries = t, time = pt(x * 5),
+                                         value = repr(x * 0.5))
+                                   for x in range(3000)])
+        return
+
+    ####################################################################
+    #
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.dir)
+        return
+
+    ####################################################################
+    #
+    def test_export(self):
+        """
+        Reads of the exported part of a series do not touch the db
+        """
+        t = TimeSeries.objects.get(name = "segments")
+        raw = t.raw_history()
+        ranged = t.raw_history(frm = pt(5000), to = pt(10000))
+        hist = t.history(frm = pt(0), to = pt(10000), bucket_size = 600,
+                         aggr_fn = TimeSeries.MEAN)
+
+        self.assertEqual(t.export_segment(pt(9995)), 2000)
+        self.assertEqual(t.export_segment(pt(9995)), 0)
+        self.assertEqual(t.export_segment(pt(12495)), 500)
+        self.assertTrue(os.path.exists(os.path.join(self.dir,
+                                                    "%d.seg" % t.pk)))
+        with self.assertNumQueries(0):
+            self.assertEqual(t.raw_history(frm = pt(5000), to = pt(10000)),
+                             ranged)
+            self.assertEqual(t.history(frm = pt(0), to = pt(10000),
+                                       bucket_size = 600,
+                                       aggr_fn = TimeSeries.MEAN), hist)
+            self.assertEqual(t.count(frm = pt(5001), to = pt(5010)), 2)
+        self.assertEqual(t.raw_history(), raw)
+        self.assertEqual(t.count(), 3000)
+        self.assertEqual(t.count(frm = pt(12000), to = pt(13000)), 201)
+
+        # Inserting in to the exported range discards the segment.
+        #
+        t.insert(repr(1.5), pt(7))
+        self.assertEqual(t.count(), 3001)
+        self.assertFalse(os.path.exists(os.path.join(self.dir,
+                                                     "%d.seg" % t.pk)))
+        return
+
+    ####################################################################
+    #
+    def test_invalidation(self):
+        """
+        Writing or deleting samples any way at all discards the segment,
+        and so does creating or deleting a timeseries.
+        """
+        t = TimeSeries.objects.get(name = "segments")
+        path = os.path.join(self.dir, "%d.seg" % t.pk)
+        t.export_segment(pt(9995))
+        t.clear()
+        self.assertFalse(os.path.exists(path))
+        Datum.objects.create(timeseries = t, time = pt(5), value = "1.5")
+        t.export_segment(pt(9995))
+        Datum.objects.create(timeseries = t, time = pt(0), value = "2.5")
+        self.assertEqual(t.raw_history(), [(pt(0), "2.5"), (pt(5), "1.5")])
+        self.assertEqual(t.count(), 2)
+
+        # Deleting the series is still a bulk delete of its samples
+        #
+        t.export_segment(pt(9995))
+        with CaptureQueriesContext(connection) as queries:
+            TimeSeries.objects.filter(pk = t.pk).delete()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse([q for q in queries.captured_queries
+                          if q["sql"].startswith("SELECT") and
+                          Datum._meta.db_table in q["sql"]])
+
+        # A stale file for a pk that gets reused
+        #
+        segments.append(path, [(0, 1.0)])
+        TimeSeries(pk = t.pk, name = "reused", fmt = TimeSeries.FLOAT).save()
+        self.assertFalse(os.path.exists(path))
+        return
+
+    ####################################################################
+    #
+    def test_export_inexact(self):
+        """
+        Exporting stops at a value that would not come back the same
+        """
+        t = TimeSeries(name = "inexact")
+        t.save()
+        for x, v in enumerate(("1", "2", "2.5", "3")):
+            t.data.create(time = pt(x), value = v)
+        self.assertEqual(t.export_segment(pt(10)), 2)
+        self.assertEqual([v for when, v in t.raw_history()],
+                         ["1", "2", "2.5", "3"])
+        return
+
+########################################################################
+########################################################################
+#
+class Benchmarks(TestCase):
+    """
+    Make sure the benchmark suite runs (with tiny series)
+    """
+
+    ####################################################################
+    #
+    def test_generate(self):
+        """
+        The synthetic series are reproducible and have the right shape
+        """
+        a = list(benchmarks.generate(100, benchmarks.COUNTER, jitter = 0.2))
+        self.assertEqual(a, list(benchmarks.generate(100, benchmarks.COUNTER,
+                                                     jitter = 0.2)))
+        self.assertEqual(len(a), 100)
+        values = [int(v) for t, v in a]
+        self.assertEqual(values, sorted(values))
+        times = [t for t, v in benchmarks.generate(10)]
+        self.assertEqual(times, [pt(benchmarks.EPOCH_START + x * 5)
+                                 for x in range(10)])
+        return
+
+    ####################################################################
+    #
+    def test_run(self):
+        """
+        A run produces results for each benchmark and cleans up after itself
+        """
+        r = benchmarks.run([2000], jitters = (0.2,), repeat = 1,
+                           insert_limit = 10)
+        names = set(x["benchmark"] for x in r["results"])
+        self.assertEqual(names, set(["import", "insert", "bulk_insert",
+                                     "raw_history",
+                                     "history", "history_segment_miss",
+                                     "export_segment",
+                                     "history_segment_hit"]))
+        self.assertEqual(TimeSeries.objects.filter(
+                name__startswith = "benchmark").count(), 0)
+        return
+
+    ####################################################################
+    #
+    def test_import_cost(self):
+        """
+        Importing the app does not load any of the optional accelerators
+        """
+        r = benchmarks.bench_import(repeat = 1)
+        self.assertTrue(r["best"] > 0)
+        self.assertEqual(r["lazy_modules_loaded"], [])
+        return
+
+########################################################################
+########################################################################
+#
+class Instrumentation(TestCase):
+    """
+    Test the per call metrics of the instrumented TimeSeries methods
+    """
+
+    ####################################################################
+    #
+    def setUp(self):
+        t = TimeSeries(name = "instrumented")
+        t.save()
+        for x,y in TS_DATA_01:
+            t.insert(y,x)
+        self.stats = []
+        call_finished.connect(self.receiver)
+        return
+
+    ####################################################################
+    #
+    def tearDown(self):
+        call_finished.disconnect(self.receiver)
+        return
+
+    ####################################################################
+    #
+    def receiver(self, sender, timeseries, stats, **kwargs):
+        self.stats.append(stats)
+        return
+
+    ####################################################################
+    #
+    def test_signal(self):
+        """
+        Each call sends one signal with the stats of the call
+        """
+        t = TimeSeries.objects.get(name = "instrumented")
+        t.history(bucket_size = 20, aggr_fn = TimeSeries.MAX)
+        t.raw_history(frm = pt(10), to = pt(20))
+        t.count()
+        self.assertEqual([x.method for x in self.stats],
+                         ["history", "raw_history", "count"])
+        hist, raw, count = self.stats
+        self.assertEqual(hist.series, "instrumented")
+        self.assertEqual(hist.rows_scanned, 20)
+        self.assertEqual(hist.rows_returned, 5)
+        self.assertEqual(hist.buckets, 5)
+        self.assertTrue(hist.queries > 0)
+        self.assertTrue(hist.seconds > 0)
+        self.assertEqual(hist.cache, None)
+        self.assertEqual(raw.rows_scanned, 3)
+        self.assertEqual(raw.rows_returned, 3)
+        self.assertEqual(raw.kwargs, {"frm": pt(10), "to": pt(20)})
+        self.assertEqual(count.rows_returned, 1)
+        return
+
+    ####################################################################
+    #
+    def test_full_query_log(self):
+        """
+        Queries are still counted once the connection's query log is full
+        """
+        t = TimeSeries.objects.get(name = "instrumented")
+        log = connection.queries_log
+        log.extend({"sql": "", "time": "0"} for x in range(log.maxlen))
+        try:
+            t.count()
+            t.raw_history()
+            self.assertEqual(len(connection.queries_log), log.maxlen)
+            self.assertTrue(connection.queries_log is log)
+        finally:
+            log.clear()
+        self.assertEqual(len(self.stats), 2)
+        self.assertTrue(all(x.queries > 0 for x in self.stats))
+        return
+
+    ####################################################################
+    #
+    def test_cache(self):
+        """
+        Calls record whether the segment file tier answered them
+        """
+        t = TimeSeries.objects.get(name = "instrumented")
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(ASTIMESERIES_SEGMENT_DIR = directory):
+                t.raw_history()
+                t.export_segment(pt(50))
+                t.raw_history(to = pt(50))
+                t.raw_history()
+                t.raw_history(frm = pt(60))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([x.cache for x in self.stats],
+                         [metrics.MISS, metrics.HIT, metrics.PARTIAL,
+                          metrics.MISS])
+        self.assertEqual(self.stats[1].queries, 0)
+        return
+
+    ####################################################################
+    #
+    def test_sinks(self):
+        """
+        The prometheus sink renders running totals and the statsd sink
+        sends a datagram per call
+        """
+        t = TimeSeries.objects.get(name = "instrumented")
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        prom = metrics.PrometheusSink()
+        statsd = metrics.StatsdSink("127.0.0.1", server.getsockname()[1])
+        metrics.add_sink(prom)
+        metrics.add_sink(statsd)
+        try:
+            t.raw_history()
+            t.raw_history()
+            lines = server.recv(4096).decode("ascii").split("\n")
+        finally:
+            metrics.remove_sink(prom)
+            metrics.remove_sink(statsd)
+            server.close()
+        text = prom.render()
+        self.assertTrue('astimeseries_calls_total{method="raw_history",'
+                        'series="instrumented",cache="none"} 2' in text)
+        self.assertTrue('astimeseries_rows_returned_total{method='
+                        '"raw_history",series="instrumented",cache="none"} 40'
+                        in text)
+        self.assertTrue(lines[0].startswith("astimeseries.raw_history.time:"))
+        self.assertTrue("astimeseries.raw_history.rows_returned:20|c" in lines)
+        return
+
+########################################################################
+########################################################################
+#
+class IngestBuffering(TestCase):
+    """
+    Test the write-behind ingest buffer
+    """
+
+    ####################################################################
+    #
+    def setUp(self):
+        t = TimeSeries(name = "buffered", fmt = TimeSeries.FLOAT)
+        t.save()
+        return
+
+    ####################################################################
+    #
+    def test_flush_on_size(self):
+        """
+        Samples are written once the buffer fills up, or when it is closed
+        """
+        t = TimeSeries.objects.get(name = "buffered")
+        buf = buffer.IngestBuffer(max_size = 5, interval = None)
+        for x in range(4):
+            buf.add(t, x, pt(x))
+        self.assertEqual(t.count(), 0)
+        with self.assertNumQueries(2):
+            buf.add(t, 4, pt(4))
+        self.assertEqual(t.count(), 5)
+        buf.add(t, 5, pt(5))
+        self.assertEqual(buf.close(), 1)
+        self.assertEqual([float(v) for when, v in t.raw_history()],
+                         list(range(6)))
+        return
+
+    ####################################################################
+    #
+    def test_coalesce(self):
+        """
+        Samples in the same minute are averaged together
+        """
+        t = TimeSeries.objects.get(name = "buffered")
+        buf = buffer.IngestBuffer(interval = None, coalesce = True)
+        for x, y in ((0, 1.0), (20, 2.0), (50, 6.0), (65, 10.0)):
+            buf.add(t, y, pt(x))
+        self.assertEqual(buf.flush(), 2)
+        self.assertEqual([(when, float(v)) for when, v in t.raw_history()],
+                         [(pt(0), 3.0), (pt(60), 10.0)])
+        return
+
+    ####################################################################
+    #
+    def test_backpressure(self):
+        """
+        Adding more than max_pending samples raises BufferFull
+        """
+        t = TimeSeries.objects.get(name = "buffered")
+        buf = buffer.IngestBuffer(max_size = 10, max_pending = 3,
+                                  interval = None)
+        for x in range(3):
+            buf.add(t, x, pt(x))
+        self.assertRaises(buffer.BufferFull, buf.add, t, 3, pt(3))
+        buf.flush()
+        buf.add(t, 3, pt(3))
+        buf.close()
+        self.assertEqual(t.count(), 4)
+        return
+
+    ####################################################################
+    #
+    def test_flush_failure(self):
+        """
+        A failed flush from add() is not raised to the caller and is not
+        retried on every add()
+        """
+        t = TimeSeries.objects.get(name = "buffered")
+        buf = buffer.IngestBuffer(max_size = 2, interval = None)
+        calls = []
+        def failing(rows, **kwargs):
+            calls.append(len(rows))
+            raise IOError("db is down")
+        Datum.objects.bulk_create = failing
+        try:
+            for x in range(5):
+                buf.add(t, x, pt(x))
+        finally:
+            del Datum.objects.bulk_create
+        self.assertEqual(calls, [2, 4])
+        self.assertEqual(t.count(), 0)
+        self.assertEqual(buf.close(), 5)
+        self.assertEqual([float(v) for when, v in t.raw_history()],
+                         list(range(5)))
+        return
+
+    ####################################################################
+    #
+    def test_segment(self):
+        """
+        Flushing samples in to the exported part of a series discards its
+        segment file
+        """
+        t = TimeSeries.objects.get(name = "buffered")
+        t.insert(1.0, pt(0))
+        t.insert(2.0, pt(60))
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(ASTIMESERIES_SEGMENT_DIR = directory):
+                for coalesce in (False, True):
+                    t.export_segment(pt(60))
+                    buf = buffer.IngestBuffer(interval = None,
+                                              coalesce = coalesce)
+                    buf.add(t, 3.0, pt(90))
+                    buf.add(t, 4.0, pt(30))
+                    self.assertEqual(buf.flush(), 2)
+                    self.assertFalse(os.path.exists(
+                            os.path.join(directory, "%d.seg" % t.pk)))
+                self.assertEqual(t.count(), 6)
+        finally:
+            shutil.rmtree(directory)
+        return
+
+    ####################################################################
+    #
+    def test_insert(self):
+        """
+        insert() uses the buffer configured in the settings
+        """
+        t = TimeSeries.objects.get(name = "buffered")
+        with override_settings(ASTIMESERIES_INGEST_BUFFER =
+                               {"max_size": 3, "interval": None}):
+            try:
+                t.insert(1.0, pt(0))
+                t.insert(2.0, pt(5))
+                self.assertEqual(t.count(), 0)
+                t.insert(3.0, pt(10))
+                self.assertEqual(t.count(), 3)
+            finally:
+                buffer.get_buffer().close()
+                buffer._buffer = None
+        t.insert(4.0, pt(15))
+        self.assertEqual(t.count(), 4)
+        return
+
+########################################################################
+########################################################################
+#
+class ParallelAggregation(TransactionTestCase):
+    """
+    Test aggregating history in parallel chunks. This is a
+    TransactionTestCase because the worker threads use their own db
+    connections and have to be able to see the test data.
+    """
+
+    ####################################################################
+    #
+    def setUp(self):
+        t = TimeSeries(name = "parallel", fmt = TimeSeries.FLOAT)
+        t.save()
+        Datum.objects.bulk_create([Datum(timeseries = t, time = pt(x * 7),
+                                         value = repr((x * 37 % 101) * 0.5))
+                                   for x in range(2000)])
+        return
+
+    ####################################################################
+    #
+    def test_parallel_history(self):
+        """
+        Every aggregation function gives the same result in parallel
+        """
+        if connection.vendor == "sqlite" and connection.is_in_memory_db() \
+                and not connection.features.can_share_in_memory_db:
+            self.skipTest("in memory sqlite db can not be shared by threads")
+        t = TimeSeries.objects.get(name = "parallel")
+        serial = dict((aggr_fn, t.history(bucket_size = 300,
+                                          aggr_fn = aggr_fn))
+                      for aggr_fn in TimeSeries.SUPPORTED_AGG_FUNCTIONS)
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(ASTIMESERIES_SEGMENT_DIR = directory):
+                # Raw rows only, then some in blocks, then some of those in
+                # a segment file as well.
+                #
+                for prepare in (lambda: None, lambda: t.seal(pt(6000)),
+                                lambda: t.export_segment(pt(3000))):
+                    prepare()
+                    for aggr_fn, expected in serial.items():
+                        parallel = t.history(bucket_size = 300,
+                                             aggr_fn = aggr_fn, workers = 3)
+                        self.assertEqual([x[0] for x in expected],
+                                         [x[0] for x in parallel])
+                        for a, b in zip(expected, parallel):
+                            self.assertAlmostEqual(a[1], b[1])
+        finally:
+            shutil.rmtree(directory)
+        return
+
+    ####################################################################
+    #
+    def test_in_transaction(self):
+        """
+        Inside a transaction history() is aggregated serially so it sees
+        the transaction's own writes
+        """
+        t = TimeSeries.objects.get(name = "parallel")
+        with transaction.atomic():
+            t.insert("1000.0", pt(1))
+            hist = t.history(bucket_size = 300, aggr_fn = TimeSeries.MAX,
+                             workers = 3)
+        self.assertEqual(hist[0], (pt(0), 1000.0))
+        return
+
+    ####################################################################
+    #
+    def test_merge_sparse(self):
+        """
+        Partial buckets for the same index are combined
+        """
+        a, b = aggregation.Bucket(), aggregation.Bucket()
+        for x in (1.0, 5.0):
+            a.add(x, x)
+        for x in (3.0, 7.0):
+            b.add(x, x)
+        merged = aggregation.merge_sparse([[(0, b)], [(0, a), (2, b)]])
+        self.assertEqual([idx for idx, bucket in merged], [0, 2])
+        bucket = merged[0][1]
+        self.assertEqual((bucket.count, bucket.min, bucket.max, bucket.first,
+                          bucket.last), (4, 1.0, 7.0, 1.0, 7.0))
+        self.assertEqual(bucket.value(TimeSeries.MEAN), 4.0)
+        self.assertEqual(aggregation.chunks(10, 3), [(0, 3), (3, 6), (6, 10)])
+        return
+
+########################################################################
+########################################################################
+#
+class Casting(TestCase):
+    """
+    Test converting values to the format of a timeseries
+    """
+
+    ####################################################################
+    #
+    def test_cast(self):
+        """
+        cast() uses the format and precision of the timeseries
+        """
+        t = TimeSeries(name = "cast", fmt = TimeSeries.DECIMAL, precision = 3)
+        self.assertEqual(t.cast("73.94"), decimal.Decimal("73.940"))
+        self.assertEqual(t.cast("1.23456"), decimal.Decimal("1.235"))
+        t.fmt = TimeSeries.FLOAT
+        self.assertEqual(t.cast("1.5"), 1.5)
+        t.fmt = TimeSeries.INT
+        self.assertEqual(t.cast("15"), 15)
+
+        # Scalar and batch casting agree, even for fractional values in an
+        # int series (load_therms_from writes those.)
+        #
+        for fmt in (TimeSeries.INT, TimeSeries.FLOAT, TimeSeries.DECIMAL):
+            t.fmt = fmt
+            values = ["2.5", "-2.5", "7", "73.94"]
+            self.assertEqual([t.cast(v) for v in values], t.cast_many(values))
+        t.fmt = TimeSeries.INT
+        t.save()
+        t.insert("73.94", pt(0))
+        self.assertEqual(t.current(), 73)
+
+        # Counter64 values are beyond what a float holds exactly
+        #
+        big = ["9007199254740993", "18446744073709551615", "-3"]
+        self.assertEqual([t.cast(v) for v in big],
+                         [2 ** 53 + 1, 2 ** 64 - 1, -3])
+        self.assertEqual(t.cast_many(big), [2 ** 53 + 1, 2 ** 64 - 1, -3])
+        self.assertEqual(t.cast_many(big[:1] + ["2.5"]), [2 ** 53 + 1, 2])
+        t.insert(big[0], pt(1))
+        self.assertEqual(t.current(), 2 ** 53 + 1)
+        return
+
+    ####################################################################
+    #
+    def test_cast_many(self):
+        """
+        Whole columns are converted in one call, leaving Nones alone
+        """
+        values = ["1", "2.5", None, 4.25]
+        self.assertEqual(casting.cast_many(values, TimeSeries.INT),
+                         [1, 2, None, 4])
+        self.assertEqual(casting.cast_many(values, TimeSeries.FLOAT),
+                         [1.0, 2.5, None, 4.25])
+        self.assertEqual(casting.cast_many(values, TimeSeries.DECIMAL, 1),
+                         [decimal.Decimal("1.0"), decimal.Decimal("2.5"),
+                          None, decimal.Decimal("4.2")])
+        self.assertEqual(casting.cast_many(values, TimeSeries.RAW), values)
+        self.assertEqual(casting.cast_many([], TimeSeries.INT), [])
+        for v in casting.cast_many(["1", "2"], TimeSeries.INT):
+            self.assertTrue(isinstance(v, int))
+        return
+
+    ####################################################################
+    #
+    def test_typed_history(self):
+        """
+        history() and current() return values in the timeseries' format
+        """
+        t = TimeSeries(name = "typed", fmt = TimeSeries.DECIMAL)
+        t.save()
+        self.assertEqual(t.current(), None)
+        for x in range(10):
+            t.insert("%d.125" % x, pt(x * 10))
+        d = t.history(bucket_size = 20, aggr_fn = TimeSeries.MAX)
+        self.assertEqual([x[1] for x in d],
+                         [decimal.Decimal("%d.12" % x) for x in (1, 3, 5, 7, 9)])
+        self.assertEqual(t.current(), decimal.Decimal("9.12"))
+        t.insert("11", pt(5))
+        self.assertEqual(t.current(), decimal.Decimal("9.12"))
+        return
+
+########################################################################
+########################################################################
+#
+@override_settings(ROOT_URLCONF = "astimeseries.urls")
+class HTTPQueries(TestCase):
+    """
+    Test the HTTP API views
+    """
+
+    ####################################################################
+    #
+    def setUp(self):
+        self.t = TimeSeries(name = "http")
+        self.t.save()
+        for x,y in TS_DATA_01:
+            self.t.insert(y,x)
+        return
+
+    ####################################################################
+    #
+    def run_commit_hooks(self):
+        """
+        Run the on commit hooks as if the test's transaction had committed
+        """
+        hooks, connection.run_on_commit = connection.run_on_commit, []
+        for sids, fn in hooks:
+            fn()
+        return
+
+    ####################################################################
+    #
+    def get(self, view, **params):
+        response = self.client.get(reverse(view, args = [self.t.pk]),
+                                   params)
+        body = b"".join(response.streaming_content) if response.streaming \
+            else response.content
+        return response, body.decode("utf-8")
+
+    ####################################################################
+    #
+    def test_history(self):
+        """
+        history as JSON and NDJSON
+        """
+        response, body = self.get("astimeseries-history", bucket_size = 20,
+                                  aggr_fn = "max", frm = "0", to = "99")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(json.loads(body),
+                         [[pt(x).isoformat(), x + 15]
+                          for x in range(0, 100, 20)])
+        response, body = self.get("astimeseries-history", bucket_size = 20,
+                                  aggr_fn = "max", format = "ndjson")
+        self.assertEqual([json.loads(x) for x in body.splitlines()],
+                         [[pt(x).isoformat(), x + 15]
+                          for x in range(0, 100, 20)])
+        for params in ({"aggr_fn": "bogus"}, {"frm": "1e20"},
+                       {"frm": "inf"}, {"to": "nan"}, {"to": "yesterday"}):
+            response, body = self.get("astimeseries-history", **params)
+            self.assertEqual(response.status_code, 400)
+        return
+
+    ####################################################################
+    #
+    def test_raw_and_current(self):
+        """
+        Raw history is cast to the timeseries format
+        """
+        response, body = self.get("astimeseries-raw-history",
+                                  frm = "1970-01-01T00:00:10",
+                                  to = "1970-01-01T00:00:20")
+        self.assertEqual(json.loads(body),
+                         [[pt(x).isoformat(), x] for x in (10, 15, 20)])
+        response, body = self.get("astimeseries-raw-history", max_points = 5)
+        self.assertEqual(len(json.loads(body)), 5)
+        response, body = self.get("astimeseries-current")
+        self.assertEqual(json.loads(body), [[pt(95).isoformat(), 95]])
+        return
+
+    ####################################################################
+    #
+    def test_etag(self):
+        """
+        An unchanged window is answered with a 304 without aggregating
+        """
+        url = reverse("astimeseries-history", args = [self.t.pk])
+        response = self.client.get(url, {"bucket_size": 20})
+        etag = response["ETag"]
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {"bucket_size": 20},
+                                       HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, {"bucket_size": 10},
+                                   HTTP_IF_NONE_MATCH = etag)
+        self.assertEqual(response.status_code, 200)
+        # Anything that changes the samples changes the ETag. Saving a
+        # Datum in a transaction touches the timeseries when it commits.
+        #
+        buf = buffer.IngestBuffer(interval = None)
+        for change in (lambda: self.t.insert(100, pt(100)),
+                       lambda: Datum.objects.create(timeseries = self.t,
+                                                    time = pt(110),
+                                                    value = "7"),
+                       lambda: self.t.seal(pt(50)),
+                       lambda: buf.add(self.t, 105, pt(105)) or buf.flush(),
+                       lambda: self.t.clear()):
+            change()
+            self.run_commit_hooks()
+            response = self.client.get(url, {"bucket_size": 20},
+                                       HTTP_IF_NONE_MATCH = etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response["ETag"], etag)
+            etag = response["ETag"]
+        return
+
+########################################################################
+########################################################################
+#
+class Snapshots(TestCase):
+    """
+    Test dumping and loading binary snapshots of timeseries
+    """
+
+    ####################################################################
+    #
+    def setUp(self):
+        """
+        An int, a float (partly sealed), a decimal and a raw timeseries
+        """
+        self.dir = tempfile.mkdtemp()
+        for fmt, values in ((TimeSeries.INT, ["1", "2", "03"]),
+                            (TimeSeries.FLOAT, [repr(x * 0.1)
+                                                for x in range(2500)]),
+                            (TimeSeries.DECIMAL, ["1.25", "2.50"]),
+                            (TimeSeries.RAW, [u"up", u"d\xf6wn"])):
+            t = TimeSeries(name = "snap-%s" % fmt, fmt = fmt, precision = 3)
+            t.save()
+            for x, v in enumerate(values):
+                t.insert(v, pt(x * 1.5))
+        TimeSeries.objects.get(name = "snap-flo").seal(pt(1000))
+        return
+
+    ####################################################################
+    #
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        return
+
+    ####################################################################
+    #
+    def test_round_trip(self):
+        """
+        Everything comes back exactly as it was, with or without compression
+        """
+        before = dict((t.name, (t.fmt, t.precision, t.raw_history()))
+                      for t in TimeSeries.objects.all())
+        for compress in (False, True):
+            path = os.path.join(self.dir, "snap-%s" % compress)
+            call_command("dump_timeseries", path, compress = compress,
+                         chunk_size = 1000, stdout = StringIO())
+            with open(path, "rb") as f:
+                self.assertRaises(snapshot.SnapshotError, snapshot.load, f)
+            TimeSeries.objects.all().delete()
+            call_command("load_timeseries", path, stdout = StringIO())
+            after = dict((t.name, (t.fmt, t.precision, t.raw_history()))
+                         for t in TimeSeries.objects.all())
+            self.assertEqual(after, before)
+        return
+
+    ####################################################################
+    #
+    def test_replace(self):
+        """
+        Replacing a timeseries drops its segment file and buffered samples
+        """
+        t = TimeSeries.objects.get(name = "snap-flo")
+        before = t.raw_history()
+        path = os.path.join(self.dir, "snap")
+        with open(path, "wb") as f:
+            snapshot.dump(f, TimeSeries.objects.filter(pk = t.pk))
+        t.insert("1.5", pt(-1))
+        with override_settings(ASTIMESERIES_SEGMENT_DIR = self.dir,
+                               ASTIMESERIES_INGEST_BUFFER =
+                               {"interval": None}):
+            try:
+                t.export_segment(pt(2000))
+                t.insert("2.5", pt(5000))
+                with open(path, "rb") as f:
+                    self.assertEqual(snapshot.load(f, replace = True),
+                                     (1, 2500))
+                self.assertFalse(os.path.exists(
+                        os.path.join(self.dir, "%d.seg" % t.pk)))
+                self.assertEqual(buffer.get_buffer().flush(), 0)
+                self.assertEqual(t.raw_history(), before)
+            finally:
+                buffer.get_buffer().close()
+                buffer._buffer = None
+        return
+
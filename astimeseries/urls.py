@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+URLs for the astimeseries HTTP API (see astimeseries.views.) Include them
+in your project with something like:
+
+    url(r'^timeseries/', include('astimeseries.urls')),
+"""
+
+# django imports
+#
+from django.conf.urls import url
+
+# Our imports
+#
+from astimeseries import views
+
+urlpatterns = [
+    url(r'^(?P<pk>\d+)/history/$', views.history,
+        name = 'astimeseries-history'),
+    url(r'^(?P<pk>\d+)/raw_history/$', views.raw_history,
+        name = 'astimeseries-raw-history'),
+    url(r'^(?P<pk>\d+)/current/$', views.current,
+        name = 'astimeseries-current'),
+    ]
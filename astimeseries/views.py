@@ -1 +1,259 @@
-# Create your views here.
+#!/usr/bin/env python
+#
+# File: $Id$
+#
+"""
+Read only HTTP API for timeseries.
+
+o <pk>/history/      - TimeSeries.history()
+o <pk>/raw_history/  - TimeSeries.raw_history()
+o <pk>/current/      - TimeSeries.current()
+
+The query parameters are the keyword arguments of the matching TimeSeries
+method. 'frm' and 'to' may be posix timestamps or ISO 8601 date times
+(naive ones are UTC.) 'format' is 'json' (the default), a JSON array of
+[<ISO 8601 time>, <value>] pairs, or 'ndjson', one such pair per line.
+
+Responses are streamed from a generator so large ranges are never turned
+in to one big string in memory.
+
+Every response has an ETag computed from the timeseries' watermark (its
+'updated' time) and the query. If the request's If-None-Match matches, we
+answer 304 Not Modified without aggregating or reading any samples - so a
+dashboard polling a window that has not changed costs the one query that
+fetches the timeseries.
+"""
+
+# system imports
+#
+import decimal
+import hashlib
+import json
+
+# django imports
+#
+from django.http import HttpResponseBadRequest, HttpResponseNotModified
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware, utc
+from django.views.decorators.http import require_GET
+
+# Our imports
+#
+from astimeseries import aggregation
+from astimeseries.models import TimeSeries
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    }
+
+# How many samples we cast and serialize at a time when streaming raw
+# history.
+#
+CHUNK_SIZE = 1000
+
+####################################################################
+#
+def _time(value):
+    """
+    Parse a time query parameter: a posix timestamp or an ISO 8601 date
+    time. Raises ValueError if it is neither.
+
+    Arguments:
+    - `value`: the parameter, or None
+    """
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = None
+    if seconds is not None:
+        try:
+            return aggregation.from_timestamp(seconds)
+        except (ValueError, OverflowError, OSError):
+            raise ValueError("'%s' is not a valid time" % value)
+    when = parse_datetime(value)
+    if when is None:
+        raise ValueError("'%s' is not a valid time" % value)
+    if is_naive(when):
+        when = make_aware(when, utc)
+    return when
+
+####################################################################
+#
+def _int(value):
+    return None if value is None else int(value)
+
+####################################################################
+#
+def _value(value):
+    """
+    Encode a single value as JSON. Decimals are written as numbers with
+    all of their digits.
+    """
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return json.dumps(value)
+
+####################################################################
+#
+def _stream(pairs, fmt):
+    """
+    A generator of the JSON or NDJSON encoding of the (datetime, value)
+    pairs, in pieces.
+
+    Arguments:
+    - `pairs`: iterable of (datetime, value) tuples
+    - `fmt`: 'json' or 'ndjson'
+    """
+    if fmt == 'json':
+        sep = ","
+        yield "["
+    else:
+        sep = "\n"
+    first = True
+    for when, value in pairs:
+        item = '["%s",%s]' % (when.isoformat(), _value(value))
+        if first:
+            first = False
+            yield item
+        else:
+            yield sep + item
+    yield "]\n" if fmt == 'json' else ("" if first else "\n")
+    return
+
+####################################################################
+#
+def _etag(timeseries, view, params):
+    """
+    The ETag for the result of `view` with `params` on `timeseries`, based
+    on its watermark.
+    """
+    key = repr((view, timeseries.watermark(), sorted(params.items())))
+    return '"%s"' % hashlib.md5(key.encode("utf-8")).hexdigest()
+
+####################################################################
+#
+def _respond(request, timeseries, view, fn):
+    """
+    Common handling for all of our views: check the format, compute the
+    ETag and answer 304 if it has not changed, otherwise call `fn` to get
+    the (datetime, value) pairs and stream them back.
+
+    Arguments:
+    - `request`: the request
+    - `timeseries`: the TimeSeries being queried
+    - `view`: the name of the view, part of the ETag
+    - `fn`: callable taking the query parameters and returning an iterable
+            of (datetime, value) tuples. ValueError is answered with 400.
+    """
+    params = dict(request.GET.items())
+    fmt = params.pop('format', 'json')
+    if fmt not in CONTENT_TYPES:
+        return HttpResponseBadRequest("'%s' is not a valid format" % fmt)
+
+    etag = _etag(timeseries, view, params)
+    if etag in [x.strip() for x in
+                request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    try:
+        pairs = fn(params)
+    except (ValueError, TypeError) as e:
+        return HttpResponseBadRequest(str(e))
+    response = StreamingHttpResponse(_stream(pairs, fmt),
+                                     content_type = CONTENT_TYPES[fmt])
+    response['ETag'] = etag
+    return response
+
+####################################################################
+#
+@require_GET
+def history(request, pk):
+    """
+    The aggregated history of a timeseries. The query parameters are
+    'frm', 'to', 'num_buckets', 'bucket_size', 'aggr_fn', 'fill' and
+    'max_points'.
+
+    Arguments:
+    - `request`: the request
+    - `pk`: the id of the TimeSeries
+    """
+    timeseries = get_object_or_404(TimeSeries, pk = pk)
+    def fn(params):
+        return timeseries.history(
+            frm = _time(params.get('frm')), to = _time(params.get('to')),
+            num_buckets = _int(params.get('num_buckets')),
+            bucket_size = _int(params.get('bucket_size')),
+            aggr_fn = params.get('aggr_fn', TimeSeries.STDDEV),
+            fill = params.get('fill'),
+            max_points = _int(params.get('max_points')))
+    return _respond(request, timeseries, 'history', fn)
+
+####################################################################
+#
+@require_GET
+def raw_history(request, pk):
+    """
+    The raw samples of a timeseries, cast to its format. The query
+    parameters are 'frm', 'to' and 'max_points'.
+
+    Arguments:
+    - `request`: the request
+    - `pk`: the id of the TimeSeries
+    """
+    timeseries = get_object_or_404(TimeSeries, pk = pk)
+    def fn(params):
+        frm, to = _time(params.get('frm')), _time(params.get('to'))
+        max_points = _int(params.get('max_points'))
+        if max_points is not None:
+            raw = timeseries.raw_history(frm, to, max_points)
+            return zip([when for when, v in raw],
+                       timeseries.cast_many([v for when, v in raw]))
+        return _cast_chunks(timeseries, timeseries._samples(frm, to))
+    return _respond(request, timeseries, 'raw_history', fn)
+
+####################################################################
+#
+def _cast_chunks(timeseries, samples):
+    """
+    A generator of (datetime, value) pairs from the samples of a
+    timeseries, casting CHUNK_SIZE values at a time.
+    """
+    chunk = []
+    for t, when, value in samples:
+        chunk.append((when, value))
+        if len(chunk) == CHUNK_SIZE:
+            for pair in zip([w for w, v in chunk],
+                            timeseries.cast_many([v for w, v in chunk])):
+                yield pair
+            chunk = []
+    for pair in zip([w for w, v in chunk],
+                    timeseries.cast_many([v for w, v in chunk])):
+        yield pair
+    return
+
+####################################################################
+#
+@require_GET
+def current(request, pk):
+    """
+    The most recent sample of a timeseries, cast to its format, as a list
+    of a single [time, value] pair (empty if it has no samples.)
+
+    Arguments:
+    - `request`: the request
+    - `pk`: the id of the TimeSeries
+    """
+    timeseries = get_object_or_404(TimeSeries, pk = pk)
+    def fn(params):
+        first, last = timeseries._bounds()
+        if last is None:
+            return []
+        return [(last, timeseries.current())]
+    return _respond(request, timeseries, 'current', fn)